@@ -1,29 +1,79 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import sys
 import time
-from pathlib import Path
 from .db import Database, TaskStatus
-from .executor import TaskExecutor
-from .src.task_display import show_status, show_task_info, list_tasks
+from .src.resources import parse_memory, format_memory
+from .src.durations import parse_duration
+
+# 执行器、守护进程和显示模块（tabulate）导入较慢，只在需要时导入
+
+# --kill、--cancel和--requeue一次最多处理的任务数，防止输错的范围遍历大量ID
+MAX_TASK_IDS = 10000
+
+# 一个标签最多展开为多少个依赖任务
+MAX_TAG_DEPENDENCIES = 10000
+
+# 按PID更新状态的回调选项，走快速路径
+CALLBACK_OPTIONS = ('--mark-running', '--mark-pending', '--mark-complete')
 
 
 def main():
     """AtlasRun - A simple command queue management tool"""
+    # 快速路径：不构建完整的参数解析器，也不检查数据库结构
+    argv = sys.argv[1:]
+    if len(argv) == 2 and argv[0] in CALLBACK_OPTIONS and argv[1].isdigit():
+        run_callback(Database(ensure_schema=False), argv[0], int(argv[1]))
+        return
+    
     parser = argparse.ArgumentParser(
         description="AtlasRun - A simple command queue management tool",
         usage="arun [options] [command...]",
         add_help=False
     )
     
-    parser.add_argument('-s', '--status', action='store_true', 
-                       help='Show current queue status')
+    parser.add_argument('-s', '--status', nargs='?', const=True, default=False, metavar='STATE',
+                       help='Show current queue status; with -l, only list tasks in STATE '
+                            '(pending, running, completed, failed, cancelled)')
     parser.add_argument('-l', action='store_true', 
-                       help='List all tasks')
+                       help='List tasks (latest 50 by default)')
+    parser.add_argument('--since', metavar='DURATION',
+                       help='With -l, only list tasks submitted within DURATION, e.g. 2d or 6h')
+    parser.add_argument('--after-id', type=int, metavar='TASK_ID',
+                       help='With -l, list tasks after TASK_ID (oldest first)')
+    parser.add_argument('--before-id', type=int, metavar='TASK_ID',
+                       help='With -l, list tasks before TASK_ID')
+    parser.add_argument('--limit', type=int, default=50, metavar='N',
+                       help='With -l, number of tasks per page (default: 50)')
     parser.add_argument('-i', '--info', type=int, metavar='TASK_ID',
                        help='Show detailed information about a specific task')
+    parser.add_argument('--usage', action='store_true',
+                       help='With -i, summarize the sampled CPU, memory and I/O usage of the task')
+    parser.add_argument('--log', type=int, metavar='TASK_ID',
+                       help='Show the output log of a task')
+    parser.add_argument('-f', '--follow', action='store_true',
+                       help='With --log, keep printing new output until the task finishes')
+    parser.add_argument('--tail', type=int, metavar='N',
+                       help='With --log, only show the last N lines')
+    parser.add_argument('--err', action='store_true',
+                       help='With --log, show the error log instead of the output log')
     parser.add_argument('-c', '--cleanup', type=int, metavar='DAYS',
-                       help='Clean up completed tasks older than specified days')
+                       help='Clean up completed tasks older than specified days, with their logs')
+    parser.add_argument('--log-rotate', metavar='SIZE',
+                       help='Rotate the log of a running task when it exceeds SIZE, e.g. 1G (0 disables)')
+    parser.add_argument('--log-keep', type=int, metavar='N',
+                       help='Keep at most N rotated log segments per task (0 keeps all)')
+    parser.add_argument('--log-compress', choices=('gzip', 'zstd', 'none'),
+                       help='Compression for rotated and finished logs (default: gzip)')
+    parser.add_argument('--log-quota', metavar='SIZE',
+                       help='Limit the total size of the logs directory, e.g. 50G (0 disables)')
+    parser.add_argument('--kill', metavar='IDS',
+                       help='Terminate running or cancel pending tasks, e.g. 12, 12-20 or 12,15')
+    parser.add_argument('--cancel', metavar='IDS',
+                       help='Cancel pending tasks so that they never run')
+    parser.add_argument('--requeue', metavar='IDS',
+                       help='Queue finished, failed or cancelled tasks again')
     parser.add_argument('-u', '--update', action='store_true',
                        help='Update task statuses (check if PIDs are still running)')
     parser.add_argument('--mark-running', type=int, metavar='PID',
@@ -32,8 +82,55 @@ def main():
                        help='Force mark a task with specific PID as pending')
     parser.add_argument('--mark-complete', type=int, metavar='PID',
                        help='Force mark a task with specific PID as completed')
+    parser.add_argument('--daemon', action='store_true',
+                       help='Run the scheduler daemon in the foreground')
+    parser.add_argument('--sampler', action='store_true',
+                       help='Sample resource usage of running tasks in the foreground')
+    parser.add_argument('--sample-interval', type=float, metavar='SECONDS',
+                       help='Set the usage sampling interval of the daemon (0 disables sampling)')
+    parser.add_argument('--sample-retention', metavar='DURATION',
+                       help='Set how long usage samples are kept, e.g. 7d (default: 7d)')
+    parser.add_argument('--batch', metavar='FILE',
+                       help="Add every line of FILE ('-' for stdin) as a separate command")
+    parser.add_argument('--after', metavar='DEPS',
+                       help='Start the command only after these tasks succeed: comma separated '
+                            'task IDs and/or tags, e.g. 12,15 or align')
+    parser.add_argument('--tag', metavar='NAME',
+                       help='Tag the command so that later commands can use --after NAME')
     parser.add_argument('-d', '--dir', metavar='DIRECTORY',
-                       help='Working directory for the command')
+                       help='Working directory for the command; with -l, only list tasks in DIRECTORY')
+    parser.add_argument('-q', '--queue', metavar='NAME',
+                       help="Queue for the command (default: 'default'); with -j, set the limit "
+                            "of this queue; with -l, only list tasks in this queue")
+    parser.add_argument('--priority', type=int, default=0, metavar='N',
+                       help='Priority of the command, higher runs first (default: 0)')
+    parser.add_argument('--retries', type=int, default=0, metavar='N',
+                       help='Retry the command up to N times when it fails (default: 0)')
+    parser.add_argument('--backoff', metavar='DURATION',
+                       help='Wait DURATION before the first retry, doubling for each further '
+                            'retry, e.g. 30s (default: 0)')
+    parser.add_argument('--timeout', metavar='DURATION',
+                       help='Terminate the command when a run exceeds DURATION, e.g. 6h')
+    parser.add_argument('--cache', action='store_true',
+                       help='Skip the command if an identical earlier run succeeded, its inputs '
+                            'are unchanged and its outputs still exist')
+    parser.add_argument('--inputs', metavar='PATHS',
+                       help='With --cache, comma separated input files of the command')
+    parser.add_argument('--outputs', metavar='PATHS',
+                       help='With --cache, comma separated output files of the command')
+    parser.add_argument('--cache-size', type=int, metavar='N',
+                       help='Keep at most N cached results, evicting the least recently used '
+                            '(default: 10000)')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+                       help='Set the maximum number of tasks running in parallel')
+    parser.add_argument('--cpus', type=int, default=1, metavar='N',
+                       help='Number of CPU cores reserved for the command (default: 1)')
+    parser.add_argument('--mem', metavar='SIZE',
+                       help='Memory reserved for the command, e.g. 512M or 32G')
+    parser.add_argument('--host-cpus', type=int, metavar='N',
+                       help='Set the CPU capacity available to the queue (default: detected)')
+    parser.add_argument('--host-mem', metavar='SIZE',
+                       help='Set the memory capacity available to the queue (default: detected)')
     parser.add_argument('-h', '--help', action='store_true',
                        help='Show this help message and exit')
     
@@ -46,26 +143,143 @@ def main():
         print("\nExamples:")
         print("  arun sleep 3                    # Add command to queue")
         print("  arun -s                         # Show queue status")
-        print("  arun -l                         # List all tasks")
+        print("  arun -l                         # List latest tasks")
+        print("  arun -l --status failed --since 2d --limit 200")
+        print("                                  # List failed tasks from the last 2 days")
         print("  arun -i 1                       # Show task details")
+        print("  arun --log 1 -f                 # Follow the output of task 1")
+        print("  arun --log 1 --err --tail 100   # Show the last 100 lines of the error log")
         print("  arun -c 7                       # Clean up old tasks")
         print("  arun -u                         # Update task statuses")
+        print("  arun --kill 12-20               # Terminate tasks 12 to 20")
+        print("  arun --requeue 12               # Run task 12 (and its skipped dependents) again")
         print("  arun -d /tmp echo hello         # Run command in specific directory")
+        print("  arun --batch commands.txt       # Add one command per line from a file")
+        print("  arun -j 16                      # Run up to 16 tasks in parallel")
+        print("  arun -q io -j 2                 # Run at most 2 tasks of queue 'io' at a time")
+        print("  arun -q io --priority 10 rsync ...")
+        print("                                  # Add a high priority command to queue 'io'")
+        print("  arun --tag map bwa mem ...      # Tag a task")
+        print("  arun --after map,12 samtools sort ...")
+        print("                                  # Run after all 'map' tasks and task 12 succeed")
+        print("  arun --retries 3 --backoff 30s --timeout 6h cmd")
+        print("                                  # Retry up to 3 times, each run limited to 6 hours")
+        print("  arun --cache --inputs a.bam,ref.fa --outputs out.vcf cmd")
+        print("                                  # Skip cmd when it already produced out.vcf from the same inputs")
+        print("  nohup arun --daemon &           # Let a long-lived daemon dispatch tasks")
+        print("  arun --cpus 8 --mem 32G cmd     # Reserve 8 cores and 32G memory")
+        print("  arun --sample-interval 10       # Let the daemon sample task usage every 10s")
+        print("  arun -i 1 --usage               # Show peak and mean usage of a task")
         return
     
     db = Database()
     
+    # 队列配置选项可以单独使用，也可以和命令一起使用
+    configuring = any(value is not None for value in (
+        args.jobs, args.host_cpus, args.host_mem, args.sample_interval, args.sample_retention,
+        args.log_rotate, args.log_keep, args.log_compress, args.log_quota, args.cache_size))
+    
+    if args.jobs is not None:
+        if args.jobs < 1:
+            print("Error: --jobs must be at least 1")
+            return
+        if args.queue:
+            db.set_queue_limit(args.queue, args.jobs)
+            print(f"Max parallel tasks of queue {args.queue} set to {args.jobs}")
+        else:
+            db.set_max_parallel(args.jobs)
+            print(f"Max parallel tasks set to {args.jobs}")
+    
+    if args.host_cpus is not None or args.host_mem is not None:
+        try:
+            host_mem_mb = parse_memory(args.host_mem) if args.host_mem is not None else None
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        db.set_host_capacity(args.host_cpus, host_mem_mb)
+        host_cpus, host_mem_mb = db.get_host_capacity()
+        print(f"Host capacity set to {host_cpus} CPUs, {format_memory(host_mem_mb)} memory")
+    
+    if args.sample_interval is not None:
+        if args.sample_interval < 0:
+            print("Error: --sample-interval must not be negative")
+            return
+        db.set_sample_interval(args.sample_interval)
+        print(f"Usage sampling interval set to {args.sample_interval:g}s" if args.sample_interval
+              else "Usage sampling disabled")
+    
+    if args.sample_retention is not None:
+        try:
+            retention = parse_duration(args.sample_retention)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        db.set_sample_retention(retention)
+        print(f"Usage samples kept for {args.sample_retention}")
+    
+    if any(value is not None for value in (args.log_rotate, args.log_keep,
+                                           args.log_compress, args.log_quota)):
+        try:
+            rotate_mb = parse_memory(args.log_rotate) if args.log_rotate is not None else None
+            quota_mb = parse_memory(args.log_quota) if args.log_quota is not None else None
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        if args.log_keep is not None and args.log_keep < 0:
+            print("Error: --log-keep must not be negative")
+            return
+        db.set_log_policy(rotate_mb, args.log_keep, args.log_compress, quota_mb)
+        policy = db.get_log_policy()
+        print(f"Log policy: rotate at {format_memory(policy.rotate_mb) if policy.rotate_mb else 'never'}, "
+              f"keep {policy.keep or 'all'} segment(s), compression {policy.compression}, "
+              f"quota {format_memory(policy.quota_mb) if policy.quota_mb else 'none'}")
+    
+    if args.cache_size is not None:
+        if args.cache_size < 1:
+            print("Error: --cache-size must be at least 1")
+            return
+        db.set_cache_max_entries(args.cache_size)
+        print(f"Keeping at most {args.cache_size} cached result(s)")
+    
+    if configuring:
+        # 并发数或容量提高后可以立即启动更多任务，守护进程被唤醒后也会使用新的采样间隔
+        request_dispatch(db)
+    
     # 处理特殊命令
+    if args.daemon:
+        from .daemon import SchedulerDaemon
+        SchedulerDaemon(db).run()
+        return
+    
+    if args.sampler:
+        from .sampler import UsageSampler
+        UsageSampler(db).run()
+        return
+    
+    # 带状态值的 --status 是列表过滤条件
+    if args.l or isinstance(args.status, str):
+        list_filtered_tasks(db, args)
+        return
+    
     if args.status:
+        from .src.task_display import show_status
         show_status(db)
         return
     
-    if args.l:
-        list_tasks(db)
+    if args.info:
+        from .src.task_display import show_task_info, show_task_usage
+        if args.usage:
+            show_task_usage(db, args.info)
+        else:
+            show_task_info(db, args.info)
         return
     
-    if args.info:
-        show_task_info(db, args.info)
+    if args.log is not None:
+        if args.tail is not None and args.tail < 0:
+            print("Error: --tail must not be negative")
+            return
+        from .src.task_logs import show_task_log
+        show_task_log(db, args.log, "err" if args.err else "out", args.tail, args.follow)
         return
     
     if args.cleanup:
@@ -76,17 +290,28 @@ def main():
         update_task_statuses(db)
         return
     
-    if args.mark_running:
-        db.mark_task_running_by_pid(args.mark_running)
-        return
-    
-    if args.mark_pending:
-        db.mark_task_pending_by_pid(args.mark_pending)
+    for option in ('kill', 'cancel', 'requeue'):
+        spec = getattr(args, option)
+        if spec is None:
+            continue
+        try:
+            task_ids = parse_task_ids(spec)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        from .executor import TaskExecutor
+        executor = TaskExecutor(db)
+        if option == 'requeue':
+            executor.requeue_tasks(task_ids)
+        else:
+            executor.cancel_tasks(task_ids, kill=option == 'kill')
         return
     
-    if args.mark_complete:
-        db.mark_task_complete_by_pid(args.mark_complete)
-        return
+    for option in CALLBACK_OPTIONS:
+        value = getattr(args, option.lstrip('-').replace('-', '_'))
+        if value is not None:
+            run_callback(db, option, value)
+            return
     
     # 获取命令参数（所有没有-开头的参数）
     command_parts = []
@@ -96,14 +321,13 @@ def main():
         else:
             print(f"Warning: Ignoring unknown option {arg}")
     
-    if not command_parts:
+    if not command_parts and args.batch is None:
+        if configuring:
+            return
         print("Error: No command specified")
         print("Use 'arun -h' for help")
         return
     
-    # 组合完整命令
-    full_command = ' '.join(command_parts)
-    
     # 确定工作目录
     working_dir = args.dir
     if working_dir:
@@ -114,25 +338,200 @@ def main():
     else:
         working_dir = os.getcwd()
     
+    # 解析资源预留
+    if args.cpus < 1:
+        print("Error: --cpus must be at least 1")
+        return
+    try:
+        mem_mb = parse_memory(args.mem) if args.mem else 0
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    
+    depends_on = ()
+    if args.after:
+        try:
+            depends_on = resolve_dependencies(db, args.after)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+    if args.tag is not None and (not args.tag or args.tag.isdigit() or ',' in args.tag):
+        print("Error: --tag must be a non-numeric name without commas")
+        return
+    
+    # 解析重试和超时设置
+    if args.retries < 0:
+        print("Error: --retries must not be negative")
+        return
+    # 解析缓存设置
+    if (args.inputs or args.outputs) and not args.cache:
+        print("Error: --inputs and --outputs require --cache")
+        return
+    inputs = split_path_list(args.inputs)
+    outputs = split_path_list(args.outputs)
+    
+    try:
+        backoff = parse_duration(args.backoff) if args.backoff else 0
+        timeout = parse_duration(args.timeout) if args.timeout else None
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+    
     # 初始化执行器并运行任务
+    from .executor import TaskExecutor
     executor = TaskExecutor(db)
     
+    if args.batch is not None:
+        try:
+            commands = read_batch_commands(args.batch)
+        except OSError as e:
+            print(f"Error: {e}")
+            return
+        if not commands:
+            print(f"Error: No commands found in {args.batch}")
+            return
+        executor.run_batch(commands, working_dir, args.cpus, mem_mb, depends_on, args.tag,
+                           args.queue or "default", args.priority, args.retries, backoff, timeout,
+                           args.cache, inputs, outputs)
+        return
+    
+    # 组合完整命令
+    full_command = ' '.join(command_parts)
+    
     try:
         # 运行任务
-        task_id = executor.run_single_task(full_command, working_dir)
+        task_id = executor.run_single_task(full_command, working_dir, args.cpus, mem_mb,
+                                           depends_on, args.tag, args.queue or "default",
+                                           args.priority, args.retries, backoff, timeout,
+                                           args.cache, inputs, outputs)
         print(f"Task {task_id} completed")
     except Exception as e:
         print(f"Error: {e}")
 
 
+def request_dispatch(db):
+    """启动能够运行的待处理任务，有守护进程时交给守护进程"""
+    from .scheduler import Scheduler, notify_daemon
+    if notify_daemon(db):
+        return
+    from .executor import TaskExecutor
+    Scheduler(db, TaskExecutor(db)).dispatch()
+
+
+def run_callback(db, option, value):
+    """处理按PID或任务ID更新状态的内部回调"""
+    if option == '--mark-running':
+        db.mark_task_running_by_pid(value)
+    elif option == '--mark-pending':
+        db.mark_task_pending_by_pid(value)
+    elif option == '--mark-complete':
+        db.mark_task_complete_by_pid(value)
+        request_dispatch(db)
+
+
+def resolve_dependencies(db, spec):
+    """将 --after 的值（逗号分隔的任务ID或标签）解析为任务ID列表"""
+    task_ids = set()
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if item.isdigit():
+            if db.get_task_by_id(int(item)) is None:
+                raise ValueError(f"Task {item} not found")
+            task_ids.add(int(item))
+        else:
+            tagged = db.get_task_ids_by_tag(item, MAX_TAG_DEPENDENCIES + 1)
+            if not tagged:
+                raise ValueError(f"No unfinished or successful tasks tagged {item}")
+            if len(tagged) > MAX_TAG_DEPENDENCIES:
+                raise ValueError(f"Tag {item} matches more than {MAX_TAG_DEPENDENCIES} tasks")
+            task_ids.update(tagged)
+    return sorted(task_ids)
+
+
+def parse_task_ids(spec):
+    """解析逗号分隔的任务ID和ID范围，例如 12、12-20 或 12,15,30-32"""
+    task_ids = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        first, _, last = item.partition('-')
+        if not first.isdigit() or (last and not last.isdigit()):
+            raise ValueError(f"Invalid task ID or range: {item}")
+        first = int(first)
+        last = int(last) if last else first
+        if last < first:
+            raise ValueError(f"Invalid task ID range: {item}")
+        if len(task_ids) + last - first + 1 > MAX_TASK_IDS:
+            raise ValueError(f"Too many task IDs in {spec}, at most {MAX_TASK_IDS} at a time")
+        task_ids.extend(range(first, last + 1))
+    if not task_ids:
+        raise ValueError(f"No task IDs in {spec}")
+    return task_ids
+
+
+def split_path_list(spec):
+    """将 --inputs/--outputs 的值（逗号分隔的路径）解析为列表"""
+    if not spec:
+        return []
+    return [path.strip() for path in spec.split(',') if path.strip()]
+
+
+def read_batch_commands(path):
+    """从文件（'-'表示标准输入）读取命令，每行一个，忽略空行和#开头的注释"""
+    if path == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(path) as f:
+            lines = f.readlines()
+    commands = []
+    for line in lines:
+        command = line.strip()
+        if command and not command.startswith('#'):
+            commands.append(command)
+    return commands
+
+
+def list_filtered_tasks(db, args):
+    """按命令行过滤条件列出任务"""
+    status = None
+    if isinstance(args.status, str):
+        try:
+            status = TaskStatus(args.status.lower())
+        except ValueError:
+            print(f"Error: Unknown status {args.status}")
+            return
+    
+    since = None
+    if args.since:
+        try:
+            since = (time.time() - parse_duration(args.since)) * 1000
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+    
+    if args.limit < 1:
+        print("Error: --limit must be at least 1")
+        return
+    
+    from .src.task_display import list_tasks
+    working_dir = os.path.abspath(args.dir) if args.dir else None
+    list_tasks(db, status, working_dir, since, args.after_id, args.before_id, args.limit, args.queue)
+
+
 def cleanup_tasks(db, days):
-    """清理任务"""
-    db.cleanup_completed_tasks(days)
-    print(f"Cleaned up tasks older than {days} days")
+    """清理任务，同时删除其日志"""
+    task_ids = db.cleanup_completed_tasks(days)
+    from .executor import TaskExecutor
+    removed = TaskExecutor(db).remove_task_files(task_ids)
+    print(f"Cleaned up {len(task_ids)} task(s) older than {days} days ({removed} file(s) removed)")
 
 
 def update_task_statuses(db):
     """更新任务状态"""
+    from .executor import TaskExecutor
     executor = TaskExecutor(db)
     executor.update_task_statuses()
 
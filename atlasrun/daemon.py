@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Event-driven scheduler daemon for AtlasRun
+"""
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Set, Tuple
+from .db import Database, Task, TaskStatus
+from .executor import TaskExecutor, record_task_exit
+from .sampler import UsageSampler
+from .src.processes import KILL_GRACE_PERIOD, signal_task
+from .src.task_logs import rotate_task_logs, finalize_task_logs, enforce_log_quota
+from .scheduler import Scheduler, WAKEUP_SIGNAL, get_daemon_pid, get_daemon_pid_file
+
+# 没有任何事件时的兜底调度间隔（秒），用于处理非守护进程启动的任务
+HOUSEKEEPING_INTERVAL = 30
+
+# 检查运行中任务日志大小的间隔（秒）
+LOG_CHECK_INTERVAL = 10
+
+
+class SchedulerDaemon:
+    """常驻调度进程：任务作为其子进程运行，通过SIGCHLD回收并立即启动下一个任务"""
+
+    def __init__(self, db: Database):
+        self.db = db
+        self.executor = TaskExecutor(db)
+        self.scheduler = Scheduler(db, self)
+        self.sampler = UsageSampler(db)
+        # 轮转和压缩大日志较慢，放到后台线程中进行，不阻塞调度
+        self.log_worker = ThreadPoolExecutor(max_workers=1)
+        # 正在后台进行的日志轮转检查
+        self.log_check: Optional[Future] = None
+        self.children: Dict[int, Tuple[int, subprocess.Popen]] = {}
+        # 设置了超时的子进程PID -> 下一次发送终止信号的时间（monotonic）
+        self.deadlines: Dict[int, float] = {}
+        # 已因超时收到SIGTERM的子进程PID
+        self.terminated: Set[int] = set()
+        self.running = False
+
+    def execute_task(self, task: Task) -> bool:
+        """由调度器调用，作为子进程启动已认领的任务"""
+        try:
+            process = self.executor.spawn_task(task, with_runner=False)
+        except Exception as e:
+            print(f"Error executing task {task.id}: {e}", flush=True)
+            self.db.fail_task(task.id, -1)
+            return False
+        self.children[process.pid] = (task.id, process)
+        if task.timeout:
+            self.deadlines[process.pid] = time.monotonic() + task.timeout
+        print(f"Task {task.id} started with PID {process.pid}", flush=True)
+        return True
+
+    def reap_children(self) -> int:
+        """回收所有已退出的子进程并记录真实退出码和资源使用，返回回收数量"""
+        reaped = 0
+        while self.children:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid not in self.children:
+                continue
+            task_id, process = self.children.pop(pid)
+            self.deadlines.pop(pid, None)
+            if pid in self.terminated:
+                # 超时的任务不留下任何进程
+                self.terminated.discard(pid)
+                signal_task(pid, signal.SIGKILL)
+            exit_code, task_status = record_task_exit(self.db, task_id, pid, status, rusage)
+            # 告知Popen子进程已被回收，避免其再次waitpid
+            process.returncode = exit_code
+            if task_status is None:
+                # 例如被其他进程误判为丢失后已经重新运行，日志属于新的运行
+                print(f"Task {task_id} exited with code {exit_code}, "
+                      f"but is no longer run by PID {pid}; exit not recorded", flush=True)
+            elif task_status == TaskStatus.PENDING:
+                # 下一次运行继续追加写入同一个日志，因此暂不压缩
+                print(f"Task {task_id} failed with exit code {exit_code}, queued for retry", flush=True)
+            else:
+                self.log_worker.submit(self.finalize_logs, task_id)
+                print(f"Task {task_id} finished with exit code {exit_code}", flush=True)
+            reaped += 1
+        return reaped
+
+    def check_timeouts(self) -> Optional[float]:
+        """终止运行超时的任务：先发送SIGTERM，KILL_GRACE_PERIOD秒后仍未退出再发送SIGKILL
+
+        返回下一次需要检查的时间（monotonic），没有设置超时的任务时返回None。
+        """
+        now = time.monotonic()
+        for pid, deadline in list(self.deadlines.items()):
+            if now < deadline:
+                continue
+            task_id = self.children[pid][0]
+            if pid in self.terminated:
+                print(f"Task {task_id} did not exit after SIGTERM, killing it", flush=True)
+                signal_task(pid, signal.SIGKILL)
+                del self.deadlines[pid]
+            else:
+                print(f"Task {task_id} exceeded its timeout, terminating it", flush=True)
+                signal_task(pid, signal.SIGTERM)
+                self.terminated.add(pid)
+                self.deadlines[pid] = now + KILL_GRACE_PERIOD
+        return min(self.deadlines.values(), default=None)
+
+    def finalize_logs(self, task_id: int) -> None:
+        """在后台线程中压缩已结束任务的日志并检查配额"""
+        policy = self.db.get_log_policy()
+        try:
+            finalize_task_logs(task_id, policy)
+            enforce_log_quota(policy, self.db.get_log_writer_ids())
+        except Exception as e:
+            print(f"Error compressing logs of task {task_id}: {e}", flush=True)
+
+    def check_logs(self) -> None:
+        """在后台线程中轮转运行中任务过大的日志，上一次检查还没完成时跳过"""
+        if self.log_check is not None and not self.log_check.done():
+            return
+        task_ids = [child[0] for child in self.children.values()]
+        if task_ids:
+            self.log_check = self.log_worker.submit(self.rotate_logs, task_ids)
+
+    def rotate_logs(self, task_ids) -> None:
+        """轮转日志，有日志被轮转时检查配额，长时间运行的任务不会等到结束才受配额限制"""
+        policy = self.db.get_log_policy()
+        try:
+            rotated = [task_id for task_id in task_ids if rotate_task_logs(task_id, policy)]
+            if rotated:
+                enforce_log_quota(policy, self.db.get_log_writer_ids())
+        except Exception as e:
+            print(f"Error rotating logs of tasks {task_ids}: {e}", flush=True)
+
+    def _on_signal(self, signum, frame):
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            self.running = False
+
+    def run(self) -> None:
+        """运行调度循环，直到收到SIGTERM或SIGINT"""
+        existing_pid = get_daemon_pid(self.db)
+        if existing_pid is not None and existing_pid != os.getpid():
+            print(f"Scheduler daemon already running with PID {existing_pid}")
+            return
+
+        pid_file = get_daemon_pid_file(self.db)
+        pid_file.write_text(str(os.getpid()))
+
+        # 信号处理函数只负责唤醒，实际工作都在主循环中完成
+        wakeup_reader, wakeup_writer = socket.socketpair()
+        wakeup_reader.setblocking(False)
+        wakeup_writer.setblocking(False)
+        signal.set_wakeup_fd(wakeup_writer.fileno())
+        for signum in (signal.SIGCHLD, WAKEUP_SIGNAL, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._on_signal)
+
+        selector = selectors.DefaultSelector()
+        selector.register(wakeup_reader, selectors.EVENT_READ)
+
+        self.running = True
+        next_sample_at = next_log_check_at = time.monotonic()
+        print(f"Scheduler daemon started with PID {os.getpid()}", flush=True)
+        try:
+            while self.running:
+                self.reap_children()
+                self.scheduler.dispatch()
+                if not self.running:
+                    break
+                next_deadline = self.check_timeouts()
+                now = time.monotonic()
+                if now >= next_log_check_at:
+                    self.check_logs()
+                    next_log_check_at = now + LOG_CHECK_INTERVAL
+                timeout = min(HOUSEKEEPING_INTERVAL, next_log_check_at - now)
+                if next_deadline is not None:
+                    timeout = min(timeout, next_deadline - now)
+                # 等待重试的任务在退避时间结束时调度
+                retry_at = self.db.get_next_eligible_time()
+                if retry_at is not None:
+                    timeout = min(timeout, retry_at / 1000 - time.time())
+                # 设置了采样间隔时顺带采集运行中任务的资源使用
+                sample_interval = self.db.get_sample_interval()
+                if sample_interval > 0:
+                    now = time.monotonic()
+                    if now >= next_sample_at:
+                        self.sampler.sample()
+                        next_sample_at = now + sample_interval
+                    timeout = min(timeout, next_sample_at - now)
+                if selector.select(timeout=max(timeout, 0)):
+                    try:
+                        while wakeup_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+        finally:
+            self.log_worker.shutdown(wait=True)
+            signal.set_wakeup_fd(-1)
+            selector.close()
+            wakeup_reader.close()
+            wakeup_writer.close()
+            try:
+                if pid_file.read_text().strip() == str(os.getpid()):
+                    pid_file.unlink()
+            except OSError:
+                pass
+            if self.children:
+                print(f"Scheduler daemon stopped, {len(self.children)} task(s) still running "
+                      f"(use 'arun -u' to update them later)", flush=True)
+            else:
+                print("Scheduler daemon stopped", flush=True)
@@ -1,7 +1,8 @@
 """
 AtlasRun database module
 """
-from .models import Task, TaskStatus
+from .models import Task, TaskStatus, StatusSummary, UsageSummary, LogPolicy, CacheStats
 from .database import Database
 
-__all__ = ['Task', 'TaskStatus', 'Database']
+__all__ = ['Task', 'TaskStatus', 'StatusSummary', 'UsageSummary', 'LogPolicy', 'CacheStats',
+           'Database']
@@ -2,9 +2,39 @@
 """
 Database connection management for AtlasRun
 """
+import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 
+# 等待其他进程释放写锁的时间（毫秒）
+BUSY_TIMEOUT_MS = 10000
+
+# 每个连接缓存的预编译语句数量
+STATEMENT_CACHE_SIZE = 256
+
+# 每个进程（及线程）复用同一个连接
+_local = threading.local()
+
+
+class TransactionalConnection(sqlite3.Connection):
+    """支持显式写事务的连接
+
+    transaction() 期间查询和更新函数中的 commit() 以及 with conn 不会提前提交，
+    事务内的多条语句作为一个整体提交或回滚。
+    """
+    transaction_depth = 0
+
+    def commit(self):
+        if self.transaction_depth == 0:
+            super().commit()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.transaction_depth:
+            return False
+        return super().__exit__(exc_type, exc_value, traceback)
+
 
 def get_db_path() -> Path:
     """获取数据库文件路径"""
@@ -14,27 +44,307 @@ def get_db_path() -> Path:
     return atlasrun_dir / "tasks.db"
 
 
+def _migrate_v1(cursor: sqlite3.Cursor) -> None:
+    """基础表结构"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            command TEXT NOT NULL,
+            working_dir TEXT NOT NULL,
+            status TEXT NOT NULL,
+            pid INTEGER,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            start_time REAL,
+            completed_at REAL,
+            exit_code INTEGER,
+            cpus INTEGER NOT NULL DEFAULT 1,
+            mem_mb INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # 未记录版本号的旧数据库缺少资源预留列
+    existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(tasks)")}
+    for column, definition in [("cpus", "INTEGER NOT NULL DEFAULT 1"),
+                               ("mem_mb", "INTEGER NOT NULL DEFAULT 0")]:
+        if column not in existing_columns:
+            cursor.execute(f"ALTER TABLE tasks ADD COLUMN {column} {definition}")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """)
+
+
+def _migrate_v2(cursor: sqlite3.Cursor) -> None:
+    """按状态/提交时间和PID查询的索引"""
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_status_created
+        ON tasks (status, created_at)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_created
+        ON tasks (created_at)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_pid
+        ON tasks (pid)
+    """)
+
+
+def _migrate_v3(cursor: sqlite3.Cursor) -> None:
+    """按状态和工作目录分页列出任务的索引"""
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_status_id
+        ON tasks (status, id)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_working_dir_id
+        ON tasks (working_dir, id)
+    """)
+
+
+def _migrate_v4(cursor: sqlite3.Cursor) -> None:
+    """任务结束时记录的资源使用（来自wait4的rusage）"""
+    cursor.execute("ALTER TABLE tasks ADD COLUMN user_time REAL")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN system_time REAL")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN max_rss_kb INTEGER")
+
+
+def _migrate_v5(cursor: sqlite3.Cursor) -> None:
+    """运行中任务的资源使用采样"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS task_usage (
+            task_id INTEGER NOT NULL,
+            sampled_at REAL NOT NULL,
+            cpu_percent REAL NOT NULL,
+            rss_kb INTEGER NOT NULL,
+            read_bps REAL NOT NULL,
+            write_bps REAL NOT NULL,
+            PRIMARY KEY (task_id, sampled_at)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_task_usage_sampled
+        ON task_usage (sampled_at)
+    """)
+
+
+def _migrate_v6(cursor: sqlite3.Cursor) -> None:
+    """任务标签和任务间的依赖关系"""
+    cursor.execute("ALTER TABLE tasks ADD COLUMN tag TEXT")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_tag_id
+        ON tasks (tag, id)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS task_deps (
+            task_id INTEGER NOT NULL,
+            depends_on INTEGER NOT NULL,
+            PRIMARY KEY (task_id, depends_on)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_task_deps_depends_on
+        ON task_deps (depends_on)
+    """)
+
+
+def _migrate_v7(cursor: sqlite3.Cursor) -> None:
+    """命名队列、队列并发上限和任务优先级"""
+    cursor.execute("ALTER TABLE tasks ADD COLUMN queue TEXT NOT NULL DEFAULT 'default'")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+    # 调度时按优先级从高到低、入队顺序（任务ID）从早到晚扫描待处理任务，无需排序
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_status_priority_id
+        ON tasks (status, priority DESC, id)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_queue_id
+        ON tasks (queue, id)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS queues (
+            name TEXT PRIMARY KEY,
+            max_parallel INTEGER NOT NULL
+        )
+    """)
+
+
+def _migrate_v8(cursor: sqlite3.Cursor) -> None:
+    """记录进程启动时间和开机ID，用于识别被复用的PID"""
+    cursor.execute("ALTER TABLE tasks ADD COLUMN proc_start INTEGER")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN boot_id TEXT")
+
+
+def _migrate_v9(cursor: sqlite3.Cursor) -> None:
+    """失败重试和运行时间限制"""
+    cursor.execute("ALTER TABLE tasks ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN max_retries INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN backoff REAL NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN timeout REAL")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN next_eligible_at REAL")
+    # 守护进程据此计算下一个等待重试的任务何时可以启动
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_status_eligible
+        ON tasks (status, next_eligible_at)
+    """)
+
+
+def _migrate_v10(cursor: sqlite3.Cursor) -> None:
+    """命令结果缓存：任务的输入输出声明和按最近使用时间淘汰的缓存表"""
+    cursor.execute("ALTER TABLE tasks ADD COLUMN cache INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN inputs TEXT")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN outputs TEXT")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN cache_key TEXT")
+    cursor.execute("ALTER TABLE tasks ADD COLUMN cached_from INTEGER")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS task_cache (
+            key TEXT PRIMARY KEY,
+            task_id INTEGER NOT NULL,
+            outputs TEXT,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_task_cache_last_used
+        ON task_cache (last_used_at)
+    """)
+
+
+def _migrate_v11(cursor: sqlite3.Cursor) -> None:
+    """每个任务尚未成功完成的依赖数量，调度时只扫描可以启动的任务
+
+    计数由触发器维护：添加或删除依赖关系、以及任务进入或离开completed状态时更新依赖它的任务。
+    """
+    cursor.execute("ALTER TABLE tasks ADD COLUMN unmet_deps INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("""
+        UPDATE tasks SET unmet_deps = (
+            SELECT COUNT(*) FROM task_deps
+            JOIN tasks AS dependency ON dependency.id = task_deps.depends_on
+            WHERE task_deps.task_id = tasks.id AND dependency.status != 'completed'
+        )
+        WHERE id IN (SELECT task_id FROM task_deps)
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_task_deps_insert AFTER INSERT ON task_deps
+        WHEN EXISTS (SELECT 1 FROM tasks WHERE id = NEW.depends_on AND status != 'completed')
+        BEGIN
+            UPDATE tasks SET unmet_deps = unmet_deps + 1 WHERE id = NEW.task_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_task_deps_delete AFTER DELETE ON task_deps
+        WHEN EXISTS (SELECT 1 FROM tasks WHERE id = OLD.depends_on AND status != 'completed')
+        BEGIN
+            UPDATE tasks SET unmet_deps = unmet_deps - 1 WHERE id = OLD.task_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_tasks_completed AFTER UPDATE OF status ON tasks
+        WHEN (OLD.status = 'completed') != (NEW.status = 'completed')
+        BEGIN
+            UPDATE tasks
+            SET unmet_deps = unmet_deps + CASE WHEN NEW.status = 'completed' THEN -1 ELSE 1 END
+            WHERE id IN (SELECT task_id FROM task_deps WHERE depends_on = NEW.id);
+        END
+    """)
+    # 可以启动的待处理任务在索引中连续排列，被依赖挡住的任务再多也不影响调度
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tasks_ready
+        ON tasks (status, unmet_deps, priority DESC, id)
+    """)
+
+
+# 数据库结构迁移，按版本号顺序执行，版本号记录在 PRAGMA user_version 中
+MIGRATIONS = [
+    (1, _migrate_v1),
+    (2, _migrate_v2),
+    (3, _migrate_v3),
+    (4, _migrate_v4),
+    (5, _migrate_v5),
+    (6, _migrate_v6),
+    (7, _migrate_v7),
+    (8, _migrate_v8),
+    (9, _migrate_v9),
+    (10, _migrate_v10),
+    (11, _migrate_v11),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
 def init_database(db_path: Path) -> None:
-    """初始化数据库表"""
-    with sqlite3.connect(db_path) as conn:
+    """初始化数据库并执行未完成的迁移，结构已是最新版本时直接返回"""
+    conn = get_connection(db_path)
+    if _get_schema_version(conn) >= SCHEMA_VERSION:
+        return
+    
+    # 加写锁后再次检查，避免多个进程同时升级
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        current_version = _get_schema_version(conn)
         cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                command TEXT NOT NULL,
-                working_dir TEXT NOT NULL,
-                status TEXT NOT NULL,
-                pid INTEGER,
-                created_at REAL NOT NULL,
-                started_at REAL,
-                start_time REAL,
-                completed_at REAL,
-                exit_code INTEGER
-            )
-        """)
+        for version, migrate in MIGRATIONS:
+            if version > current_version:
+                migrate(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 
 def get_connection(db_path: Path) -> sqlite3.Connection:
-    """获取数据库连接"""
-    return sqlite3.connect(db_path)
+    """获取当前进程的数据库连接，首次调用时创建并设置WAL等参数"""
+    key = (os.getpid(), str(db_path))
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    
+    conn = connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(
+            str(db_path),
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            factory=TransactionalConnection
+        )
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        # WAL模式下读写互不阻塞，NORMAL同步级别在WAL下仍能保证数据库一致性
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        connections[key] = conn
+    return conn
+
+
+@contextmanager
+def transaction(db_path: Path):
+    """以 BEGIN IMMEDIATE 开始写事务，其他进程的写操作等待事务结束
+
+    可以嵌套，只有最外层在退出时提交（出错时回滚）。
+    """
+    conn = get_connection(db_path)
+    if conn.transaction_depth:
+        conn.transaction_depth += 1
+        try:
+            yield conn
+        finally:
+            conn.transaction_depth -= 1
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    conn.transaction_depth = 1
+    try:
+        yield conn
+    except BaseException:
+        conn.transaction_depth = 0
+        conn.rollback()
+        raise
+    conn.transaction_depth = 0
+    conn.commit()
@@ -3,59 +3,219 @@
 Main Database class for AtlasRun
 """
 from pathlib import Path
-from .connection import get_db_path, init_database
+from .connection import get_db_path, init_database, transaction
+from ..src.resources import detect_host_cpus, detect_host_mem_mb
 from .queries import (
-    get_pending_tasks, get_running_tasks, get_all_running_tasks,
-    get_completed_tasks, get_all_tasks, get_task_by_id, get_task_by_pid
+    get_pending_tasks, get_running_tasks, get_all_running_tasks, get_cancelling_tasks, get_log_writer_ids,
+    get_completed_tasks, get_all_tasks, get_tasks_page, get_task_by_id, get_task_by_pid,
+    get_ready_tasks, get_next_eligible_time, get_task_dependencies, get_task_ids_by_tag,
+    get_queue_limits, count_running_by_queue, get_queue_counts,
+    count_running_tasks, get_status_counts, get_reserved_resources, get_usage_summary, get_setting,
+    get_cache_entry, get_cache_stats
 )
+from .models import CacheStats, LogPolicy, StatusSummary
 from .updates import (
-    add_task, update_pid, fail_task, mark_task_pending_by_pid, 
-    mark_task_complete_by_pid, mark_task_running_by_pid, cleanup_completed_tasks
+    add_task, add_tasks, update_pid, claim_task, complete_task, finish_task, mark_task_lost, fail_task,
+    cancel_task, finish_cancel, requeue_task, complete_from_cache, record_cache_miss,
+    mark_task_pending_by_pid, 
+    mark_task_complete_by_pid, mark_task_running_by_pid, cleanup_completed_tasks,
+    add_usage_samples, prune_usage_samples, set_queue_limit, set_setting
 )
 
+DEFAULT_MAX_PARALLEL = 1
+
+# 资源使用采样间隔（秒），0表示调度守护进程不采样
+DEFAULT_SAMPLE_INTERVAL = 0
+
+# 资源使用采样的保留天数
+DEFAULT_SAMPLE_RETENTION_DAYS = 7
+
+# 命令结果缓存最多保留的条目数，超出时淘汰最久未使用的条目
+DEFAULT_CACHE_MAX_ENTRIES = 10000
+
+# 默认的日志策略：超过1G时轮转，保留所有轮转分段，任务结束后gzip压缩，不限制总大小
+DEFAULT_LOG_POLICY = LogPolicy(rotate_mb=1024, keep=0, compression="gzip", quota_mb=0)
+
 
 class Database:
     """AtlasRun数据库管理类"""
     
-    def __init__(self, db_path: str = None):
+    def __init__(self, db_path: str = None, ensure_schema: bool = True):
         if db_path is None:
             self.db_path = str(get_db_path())
         else:
             self.db_path = db_path
         
-        init_database(Path(self.db_path))
+        # 任务脚本的内部回调可以跳过结构检查，数据库在提交任务时已经初始化
+        if ensure_schema:
+            init_database(Path(self.db_path))
+    
+    def transaction(self):
+        """写事务：其中的查询和更新作为一个整体执行，期间其他进程无法写入"""
+        return transaction(self.db_path)
     
     # 查询方法
-    def get_pending_tasks(self):
-        return get_pending_tasks(self.db_path)
+    def get_pending_tasks(self, limit: int = -1):
+        return get_pending_tasks(self.db_path, limit)
     
-    def get_running_tasks(self):
-        return get_running_tasks(self.db_path)
+    def get_ready_tasks(self, limit: int = -1, exclude_queues=()):
+        return get_ready_tasks(self.db_path, limit, exclude_queues)
+    
+    def get_next_eligible_time(self):
+        return get_next_eligible_time(self.db_path)
+    
+    def get_running_tasks(self, limit: int = -1):
+        return get_running_tasks(self.db_path, limit)
     
     def get_all_running_tasks(self):
         return get_all_running_tasks(self.db_path)
     
+    def get_cancelling_tasks(self):
+        return get_cancelling_tasks(self.db_path)
+    
+    def get_log_writer_ids(self):
+        return get_log_writer_ids(self.db_path)
+    
     def get_completed_tasks(self):
         return get_completed_tasks(self.db_path)
     
     def get_all_tasks(self, limit: int = 100):
         return get_all_tasks(self.db_path, limit)
     
+    def get_tasks_page(self, status=None, working_dir: str = None, since: float = None,
+                       after_id: int = None, before_id: int = None, limit: int = 50,
+                       queue: str = None):
+        return get_tasks_page(self.db_path, status, working_dir, since, after_id, before_id,
+                              limit, queue)
+    
     def get_task_by_id(self, task_id: int):
         return get_task_by_id(self.db_path, task_id)
     
     def get_task_by_pid(self, pid: int):
         return get_task_by_pid(self.db_path, pid)
     
+    def get_task_dependencies(self, task_id: int):
+        return get_task_dependencies(self.db_path, task_id)
+    
+    def get_task_ids_by_tag(self, tag: str, limit: int = -1):
+        return get_task_ids_by_tag(self.db_path, tag, limit)
+    
+    def get_status_summary(self, head: int = 10) -> StatusSummary:
+        """各状态的任务数量、最早的若干个running和最先运行的若干个pending任务，以及各队列的情况"""
+        limits = get_queue_limits(self.db_path)
+        queues = {name: (0, 0, limit) for name, limit in limits.items()}
+        for name, (running, pending) in get_queue_counts(self.db_path).items():
+            queues[name] = (running, pending, limits.get(name))
+        return StatusSummary(
+            counts=get_status_counts(self.db_path),
+            running=get_running_tasks(self.db_path, head),
+            pending=get_pending_tasks(self.db_path, head),
+            queues=queues
+        )
+    
+    def count_running_tasks(self) -> int:
+        return count_running_tasks(self.db_path)
+    
+    def count_running_by_queue(self):
+        return count_running_by_queue(self.db_path)
+    
+    def get_queue_limits(self):
+        return get_queue_limits(self.db_path)
+    
+    def get_max_parallel(self) -> int:
+        return int(get_setting(self.db_path, "max_parallel", DEFAULT_MAX_PARALLEL))
+    
+    def get_host_capacity(self):
+        """返回主机可用的CPU核数和内存（MB），未配置时自动检测"""
+        cpus = get_setting(self.db_path, "host_cpus")
+        mem_mb = get_setting(self.db_path, "host_mem_mb")
+        return (
+            int(cpus) if cpus is not None else detect_host_cpus(),
+            int(mem_mb) if mem_mb is not None else detect_host_mem_mb()
+        )
+    
+    def get_reserved_resources(self):
+        return get_reserved_resources(self.db_path)
+    
+    def get_usage_summary(self, task_id: int):
+        return get_usage_summary(self.db_path, task_id)
+    
+    def get_sample_interval(self) -> float:
+        return float(get_setting(self.db_path, "sample_interval", DEFAULT_SAMPLE_INTERVAL))
+    
+    def get_sample_retention(self) -> float:
+        """采样保留时长（秒）"""
+        return float(get_setting(self.db_path, "sample_retention",
+                                 DEFAULT_SAMPLE_RETENTION_DAYS * 24 * 3600))
+    
+    def get_cache_entry(self, key: str):
+        return get_cache_entry(self.db_path, key)
+    
+    def get_cache_stats(self) -> CacheStats:
+        return get_cache_stats(self.db_path)
+    
+    def get_cache_max_entries(self) -> int:
+        return int(get_setting(self.db_path, "cache_max_entries", DEFAULT_CACHE_MAX_ENTRIES))
+    
+    def get_log_policy(self) -> LogPolicy:
+        values = {field: get_setting(self.db_path, f"log_{field}")
+                  for field in LogPolicy._fields}
+        return LogPolicy(
+            rotate_mb=int(values["rotate_mb"] or DEFAULT_LOG_POLICY.rotate_mb),
+            keep=int(values["keep"] or DEFAULT_LOG_POLICY.keep),
+            compression=values["compression"] or DEFAULT_LOG_POLICY.compression,
+            quota_mb=int(values["quota_mb"] or DEFAULT_LOG_POLICY.quota_mb)
+        )
+    
     # 更新方法
-    def add_task(self, command: str, working_dir: str) -> int:
-        return add_task(self.db_path, command, working_dir)
+    def add_task(self, command: str, working_dir: str, cpus: int = 1, mem_mb: int = 0,
+                 depends_on=(), tag: str = None, queue: str = "default", priority: int = 0,
+                 max_retries: int = 0, backoff: float = 0, timeout: float = None,
+                 cache: bool = False, inputs=(), outputs=()) -> int:
+        return add_task(self.db_path, command, working_dir, cpus, mem_mb, depends_on, tag,
+                        queue, priority, max_retries, backoff, timeout, cache, inputs, outputs)
+    
+    def add_tasks(self, commands, working_dir: str, cpus: int = 1, mem_mb: int = 0,
+                  depends_on=(), tag: str = None, queue: str = "default", priority: int = 0,
+                  max_retries: int = 0, backoff: float = 0, timeout: float = None,
+                  cache: bool = False, inputs=(), outputs=()):
+        return add_tasks(self.db_path, commands, working_dir, cpus, mem_mb, depends_on, tag,
+                         queue, priority, max_retries, backoff, timeout, cache, inputs, outputs)
+    
+    def update_pid(self, task_id: int, pid: int, proc_start: int = None, boot_id: str = None):
+        update_pid(self.db_path, task_id, pid, proc_start, boot_id)
     
-    def update_pid(self, task_id: int, pid: int):
-        update_pid(self.db_path, task_id, pid)
+    def claim_task(self, task_id: int) -> bool:
+        return claim_task(self.db_path, task_id)
+    
+    def complete_task(self, task_id: int, exit_code: int = 0):
+        complete_task(self.db_path, task_id, exit_code)
+    
+    def finish_task(self, task_id: int, pid: int, exit_code: int, user_time: float = None,
+                    system_time: float = None, max_rss_kb: int = None):
+        return finish_task(self.db_path, task_id, pid, exit_code, user_time, system_time,
+                           max_rss_kb)
+    
+    def mark_task_lost(self, task_id: int) -> bool:
+        return mark_task_lost(self.db_path, task_id)
     
     def fail_task(self, task_id: int, exit_code: int):
-        fail_task(self.db_path, task_id, exit_code)
+        return fail_task(self.db_path, task_id, exit_code)
+    
+    def cancel_task(self, task_id: int) -> bool:
+        return cancel_task(self.db_path, task_id)
+    
+    def finish_cancel(self, task_id: int) -> bool:
+        return finish_cancel(self.db_path, task_id)
+    
+    def requeue_task(self, task_id: int) -> bool:
+        return requeue_task(self.db_path, task_id)
+    
+    def complete_from_cache(self, task_id: int, source_task_id: int, key: str) -> bool:
+        return complete_from_cache(self.db_path, task_id, source_task_id, key)
+    
+    def record_cache_miss(self, task_id: int, key: str = None):
+        record_cache_miss(self.db_path, task_id, key, self.get_cache_max_entries())
     
     def mark_task_pending_by_pid(self, pid: int):
         mark_task_pending_by_pid(self.db_path, pid)
@@ -67,4 +227,38 @@ class Database:
         mark_task_running_by_pid(self.db_path, pid)
     
     def cleanup_completed_tasks(self, days: int = 7):
-        cleanup_completed_tasks(self.db_path, days)
+        return cleanup_completed_tasks(self.db_path, days)
+    
+    def add_usage_samples(self, samples):
+        add_usage_samples(self.db_path, samples)
+    
+    def prune_usage_samples(self, before: float) -> int:
+        return prune_usage_samples(self.db_path, before)
+    
+    def set_log_policy(self, rotate_mb: int = None, keep: int = None,
+                       compression: str = None, quota_mb: int = None):
+        for field, value in (("rotate_mb", rotate_mb), ("keep", keep),
+                             ("compression", compression), ("quota_mb", quota_mb)):
+            if value is not None:
+                set_setting(self.db_path, f"log_{field}", value)
+    
+    def set_sample_interval(self, seconds: float):
+        set_setting(self.db_path, "sample_interval", seconds)
+    
+    def set_sample_retention(self, seconds: float):
+        set_setting(self.db_path, "sample_retention", seconds)
+    
+    def set_cache_max_entries(self, max_entries: int):
+        set_setting(self.db_path, "cache_max_entries", max_entries)
+    
+    def set_max_parallel(self, max_parallel: int):
+        set_setting(self.db_path, "max_parallel", max_parallel)
+    
+    def set_queue_limit(self, name: str, max_parallel: int):
+        set_queue_limit(self.db_path, name, max_parallel)
+    
+    def set_host_capacity(self, cpus: int = None, mem_mb: int = None):
+        if cpus is not None:
+            set_setting(self.db_path, "host_cpus", cpus)
+        if mem_mb is not None:
+            set_setting(self.db_path, "host_mem_mb", mem_mb)
@@ -2,9 +2,8 @@
 """
 Data models for AtlasRun
 """
-from dataclasses import dataclass
 from enum import Enum
-from typing import Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 
 class TaskStatus(Enum):
@@ -12,10 +11,13 @@ class TaskStatus(Enum):
     RUNNING = "running"
     COMPLETED = "completed"
     FAILED = "failed"
+    CANCELLED = "cancelled"
+    # 已被终止但进程还未全部退出，仍占用槽位和预留的资源
+    CANCELLING = "cancelling"
 
 
-@dataclass
-class Task:
+class Task(NamedTuple):
+    """任务记录（基于元组，没有逐实例的__dict__，大量读取时占用内存更少）"""
     id: int
     command: str
     working_dir: str
@@ -26,3 +28,61 @@ class Task:
     start_time: Optional[float]
     completed_at: Optional[float]
     exit_code: Optional[int]
+    cpus: int = 1
+    mem_mb: int = 0
+    user_time: Optional[float] = None
+    system_time: Optional[float] = None
+    max_rss_kb: Optional[int] = None
+    tag: Optional[str] = None
+    queue: str = "default"
+    priority: int = 0
+    proc_start: Optional[int] = None
+    boot_id: Optional[str] = None
+    attempts: int = 0
+    max_retries: int = 0
+    backoff: float = 0.0
+    timeout: Optional[float] = None
+    next_eligible_at: Optional[float] = None
+    cache: bool = False
+    inputs: Optional[str] = None
+    outputs: Optional[str] = None
+    cache_key: Optional[str] = None
+    cached_from: Optional[int] = None
+
+
+class StatusSummary(NamedTuple):
+    counts: Dict[TaskStatus, int]
+    running: List[Task]
+    pending: List[Task]
+    # 队列名 -> (运行中任务数, 待处理任务数, 并发上限或None)
+    queues: Dict[str, Tuple[int, int, Optional[int]]]
+
+
+class CacheStats(NamedTuple):
+    """命令结果缓存的命中、未命中次数和当前缓存条目数"""
+    hits: int
+    misses: int
+    entries: int
+
+
+class UsageSummary(NamedTuple):
+    """任务资源使用采样的汇总，CPU为百分比，内存为KB，读写为字节/秒"""
+    samples: int
+    first_at: float
+    last_at: float
+    peak_cpu_percent: float
+    mean_cpu_percent: float
+    peak_rss_kb: int
+    mean_rss_kb: float
+    peak_read_bps: float
+    mean_read_bps: float
+    peak_write_bps: float
+    mean_write_bps: float
+
+
+class LogPolicy(NamedTuple):
+    """任务日志的轮转、压缩和配额设置，大小为MB，0表示不限制"""
+    rotate_mb: int
+    keep: int
+    compression: str
+    quota_mb: int
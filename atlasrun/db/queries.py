@@ -3,211 +3,324 @@
 Task query operations for AtlasRun
 """
 import sqlite3
-from typing import List, Optional
-from .models import Task, TaskStatus
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from .models import CacheStats, Task, TaskStatus, UsageSummary
 from .connection import get_connection
 
+# tasks表的列，顺序与Task字段一致
+TASK_COLUMNS = """id, command, working_dir, status, pid, created_at,
+                  started_at, start_time, completed_at, exit_code, cpus, mem_mb,
+                  user_time, system_time, max_rss_kb, tag, queue, priority,
+                  proc_start, boot_id, attempts, max_retries, backoff, timeout,
+                  next_eligible_at, cache, inputs, outputs, cache_key, cached_from"""
 
-def get_pending_tasks(db_path: str) -> List[Task]:
-    """获取所有待处理的任务"""
-    with get_connection(db_path) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, command, working_dir, status, pid, created_at, 
-                   started_at, start_time, completed_at, exit_code
-            FROM tasks 
-            WHERE status = ? 
-            ORDER BY created_at ASC
-        """, (TaskStatus.PENDING.value,))
-        
-        tasks = []
-        for row in cursor.fetchall():
-            task = Task(
-                id=row[0],
-                command=row[1],
-                working_dir=row[2],
-                status=TaskStatus(row[3]),
-                pid=row[4],
-                created_at=row[5],
-                started_at=row[6],
-                start_time=row[7],
-                completed_at=row[8],
-                exit_code=row[9]
-            )
-            tasks.append(task)
-        return tasks
-
-
-def get_running_tasks(db_path: str) -> List[Task]:
-    """获取所有正在运行的任务"""
+_STATUS_BY_VALUE = {status.value: status for status in TaskStatus}
+
+
+def task_row_factory(cursor: sqlite3.Cursor, row: tuple) -> Task:
+    """将tasks表的一行直接转换为Task"""
+    return Task(row[0], row[1], row[2], _STATUS_BY_VALUE[row[3]], *row[4:])
+
+
+def iter_tasks(db_path: str, where: str = "", params: tuple = ()) -> Iterator[Task]:
+    """执行任务查询，逐行返回Task而不一次性读取全部结果"""
+    cursor = get_connection(db_path).cursor()
+    cursor.row_factory = task_row_factory
+    return cursor.execute(f"SELECT {TASK_COLUMNS} FROM tasks {where}", params)
+
+
+def get_pending_tasks(db_path: str, limit: int = -1) -> List[Task]:
+    """获取待处理的任务（按优先级和入队顺序，limit为-1时不限制数量）"""
+    return list(iter_tasks(db_path, """
+        WHERE status = ?
+        ORDER BY priority DESC, id ASC
+        LIMIT ?
+    """, (TaskStatus.PENDING.value, limit)))
+
+
+def get_ready_tasks(db_path: str, limit: int = -1, exclude_queues: Sequence[str] = ()) -> List[Task]:
+    """获取可以启动的待处理任务：没有依赖，或依赖的任务都已成功完成，且不在重试等待时间内
+
+    按优先级从高到低、入队顺序（任务ID）从早到晚排序，exclude_queues中的队列（已满）被跳过。
+    任务ID在插入事务中分配，多个进程同时提交时也能反映真实的入队顺序。
+    """
+    queue_filter = ""
+    if exclude_queues:
+        queue_filter = f"AND queue NOT IN ({','.join('?' * len(exclude_queues))})"
+    return list(iter_tasks(db_path, f"""
+        WHERE status = ? AND unmet_deps = 0 {queue_filter}
+        AND (next_eligible_at IS NULL OR next_eligible_at <= ?)
+        ORDER BY priority DESC, id ASC
+        LIMIT ?
+    """, (TaskStatus.PENDING.value, *exclude_queues, time.time() * 1000, limit)))
+
+
+def get_next_eligible_time(db_path: str) -> Optional[float]:
+    """等待重试的待处理任务中最早可以启动的时间（毫秒时间戳），没有时返回None"""
     with get_connection(db_path) as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT id, command, working_dir, status, pid, created_at, 
-                   started_at, start_time, completed_at, exit_code
-            FROM tasks 
-            WHERE status = ?
-        """, (TaskStatus.RUNNING.value,))
-        
-        tasks = []
-        for row in cursor.fetchall():
-            task = Task(
-                id=row[0],
-                command=row[1],
-                working_dir=row[2],
-                status=TaskStatus(row[3]),
-                pid=row[4],
-                created_at=row[5],
-                started_at=row[6],
-                start_time=row[7],
-                completed_at=row[8],
-                exit_code=row[9]
-            )
-            tasks.append(task)
-        return tasks
+            SELECT MIN(next_eligible_at) FROM tasks
+            WHERE status = ? AND next_eligible_at > ?
+        """, (TaskStatus.PENDING.value, time.time() * 1000))
+        return cursor.fetchone()[0]
+
+
+def get_running_tasks(db_path: str, limit: int = -1) -> List[Task]:
+    """获取正在运行的任务（按提交顺序，limit为-1时不限制数量）"""
+    return list(iter_tasks(db_path, """
+        WHERE status = ?
+        ORDER BY id ASC
+        LIMIT ?
+    """, (TaskStatus.RUNNING.value, limit)))
 
 
 def get_all_running_tasks(db_path: str) -> List[Task]:
     """获取所有状态为running的任务"""
+    return list(iter_tasks(db_path, """
+        WHERE status = ?
+        ORDER BY started_at ASC
+    """, (TaskStatus.RUNNING.value,)))
+
+
+def get_cancelling_tasks(db_path: str) -> List[Task]:
+    """获取已被终止、但进程可能还未全部退出的任务"""
+    return list(iter_tasks(db_path, """
+        WHERE status = ?
+        ORDER BY id ASC
+    """, (TaskStatus.CANCELLING.value,)))
+
+
+def get_log_writer_ids(db_path: str) -> List[int]:
+    """日志仍可能被写入的任务ID：运行中和正在终止的任务，以及已运行过、等待重试的任务"""
     with get_connection(db_path) as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT id, command, working_dir, status, pid, created_at, 
-                   started_at, start_time, completed_at, exit_code
-            FROM tasks 
-            WHERE status = ?
-            ORDER BY started_at ASC
-        """, (TaskStatus.RUNNING.value,))
-        
-        tasks = []
-        for row in cursor.fetchall():
-            task = Task(
-                id=row[0],
-                command=row[1],
-                working_dir=row[2],
-                status=TaskStatus(row[3]),
-                pid=row[4],
-                created_at=row[5],
-                started_at=row[6],
-                start_time=row[7],
-                completed_at=row[8],
-                exit_code=row[9]
-            )
-            tasks.append(task)
-        return tasks
+            SELECT id FROM tasks
+            WHERE status IN (?, ?) OR (status = ? AND attempts > 0)
+        """, (TaskStatus.RUNNING.value, TaskStatus.CANCELLING.value, TaskStatus.PENDING.value))
+        return [row[0] for row in cursor.fetchall()]
 
 
 def get_completed_tasks(db_path: str) -> List[Task]:
-    """获取所有已完成的任务"""
+    """获取所有已结束的任务（最新的在前）"""
+    return list(iter_tasks(db_path, """
+        WHERE status IN (?, ?, ?)
+        ORDER BY created_at DESC
+    """, (TaskStatus.COMPLETED.value, TaskStatus.FAILED.value, TaskStatus.CANCELLED.value)))
+
+
+def get_all_tasks(db_path: str, limit: int = 100) -> List[Task]:
+    """获取所有任务（最新的在前，限制数量）"""
+    return list(iter_tasks(db_path, """
+        ORDER BY created_at DESC
+        LIMIT ?
+    """, (limit,)))
+
+
+def get_tasks_page(db_path: str, status: Optional[TaskStatus] = None,
+                   working_dir: Optional[str] = None, since: Optional[float] = None,
+                   after_id: Optional[int] = None, before_id: Optional[int] = None,
+                   limit: int = 50, queue: Optional[str] = None) -> List[Task]:
+    """按条件分页获取任务（基于ID的keyset分页，结果按ID升序）
+
+    指定after_id时返回该ID之后最早的limit个任务，否则返回before_id（或最新任务）
+    之前最近的limit个任务。since为毫秒时间戳。
+    """
+    conditions = []
+    params = []
+    if status is not None:
+        conditions.append("status = ?")
+        params.append(status.value)
+    if working_dir is not None:
+        conditions.append("working_dir = ?")
+        params.append(working_dir)
+    if queue is not None:
+        conditions.append("queue = ?")
+        params.append(queue)
+    if since is not None:
+        conditions.append("created_at >= ?")
+        params.append(since)
+    if after_id is not None:
+        conditions.append("id > ?")
+        params.append(after_id)
+    if before_id is not None:
+        conditions.append("id < ?")
+        params.append(before_id)
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    order = "ASC" if after_id is not None else "DESC"
+    tasks = list(iter_tasks(db_path, f"""
+        {where}
+        ORDER BY id {order}
+        LIMIT ?
+    """, tuple(params) + (limit,)))
+    if order == "DESC":
+        tasks.reverse()
+    return tasks
+
+
+def get_task_by_id(db_path: str, task_id: int) -> Optional[Task]:
+    """根据ID获取任务"""
+    return iter_tasks(db_path, "WHERE id = ?", (task_id,)).fetchone()
+
+
+def get_task_by_pid(db_path: str, pid: int) -> Optional[Task]:
+    """根据PID获取任务"""
+    return iter_tasks(db_path, "WHERE pid = ?", (pid,)).fetchone()
+
+
+def get_task_dependencies(db_path: str, task_id: int) -> List[Tuple[int, Optional[TaskStatus]]]:
+    """获取任务依赖的任务ID及其状态（已被清理的任务状态为None）"""
     with get_connection(db_path) as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT id, command, working_dir, status, pid, created_at, 
-                   started_at, start_time, completed_at, exit_code
-            FROM tasks 
-            WHERE status IN (?, ?)
-            ORDER BY created_at DESC
-        """, (TaskStatus.COMPLETED.value, TaskStatus.FAILED.value))
-        
-        tasks = []
-        for row in cursor.fetchall():
-            task = Task(
-                id=row[0],
-                command=row[1],
-                working_dir=row[2],
-                status=TaskStatus(row[3]),
-                pid=row[4],
-                created_at=row[5],
-                started_at=row[6],
-                start_time=row[7],
-                completed_at=row[8],
-                exit_code=row[9]
-            )
-            tasks.append(task)
-        return tasks
+            SELECT task_deps.depends_on, tasks.status FROM task_deps
+            LEFT JOIN tasks ON tasks.id = task_deps.depends_on
+            WHERE task_deps.task_id = ?
+            ORDER BY task_deps.depends_on
+        """, (task_id,))
+        return [(dependency, _STATUS_BY_VALUE.get(status)) for dependency, status in cursor.fetchall()]
 
 
-def get_all_tasks(db_path: str, limit: int = 100) -> List[Task]:
-    """获取所有任务（限制数量）"""
+def get_task_ids_by_tag(db_path: str, tag: str, limit: int = -1) -> List[int]:
+    """获取带有指定标签、可以作为依赖的任务ID：未结束的任务，以及每个命令最近一次成功的运行
+
+    失败或被取消的旧运行不计入，部分失败后重新提交的任务不会让新的依赖直接失败。
+    """
     with get_connection(db_path) as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT id, command, working_dir, status, pid, created_at, 
-                   started_at, start_time, completed_at, exit_code
-            FROM tasks 
-            ORDER BY created_at DESC
+            SELECT id FROM tasks WHERE tag = ? AND status IN (?, ?)
+            UNION
+            SELECT MAX(id) FROM tasks WHERE tag = ? AND status = ?
+            GROUP BY command, working_dir
+            ORDER BY id
             LIMIT ?
-        """, (limit,))
-        
-        tasks = []
-        for row in cursor.fetchall():
-            task = Task(
-                id=row[0],
-                command=row[1],
-                working_dir=row[2],
-                status=TaskStatus(row[3]),
-                pid=row[4],
-                created_at=row[5],
-                started_at=row[6],
-                start_time=row[7],
-                completed_at=row[8],
-                exit_code=row[9]
-            )
-            tasks.append(task)
-        return tasks
+        """, (tag, TaskStatus.PENDING.value, TaskStatus.RUNNING.value,
+              tag, TaskStatus.COMPLETED.value, limit))
+        return [row[0] for row in cursor.fetchall()]
 
 
-def get_task_by_id(db_path: str, task_id: int) -> Optional[Task]:
-    """根据ID获取任务"""
+def get_status_counts(db_path: str) -> Dict[TaskStatus, int]:
+    """按状态统计任务数量"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT status, COUNT(*) FROM tasks GROUP BY status
+        """)
+        counts = {status: 0 for status in TaskStatus}
+        for status, count in cursor.fetchall():
+            counts[_STATUS_BY_VALUE[status]] = count
+        return counts
+
+
+def count_running_tasks(db_path: str) -> int:
+    """统计占用槽位的任务数量（running以及正在终止的任务）"""
     with get_connection(db_path) as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT id, command, working_dir, status, pid, created_at, 
-                   started_at, start_time, completed_at, exit_code
-            FROM tasks 
-            WHERE id = ?
+            SELECT COUNT(*) FROM tasks WHERE status IN (?, ?)
+        """, (TaskStatus.RUNNING.value, TaskStatus.CANCELLING.value))
+        return cursor.fetchone()[0]
+
+
+def get_reserved_resources(db_path: str) -> Tuple[int, int]:
+    """统计运行中（以及正在终止的）任务预留的CPU核数和内存（MB）"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COALESCE(SUM(cpus), 0), COALESCE(SUM(mem_mb), 0)
+            FROM tasks WHERE status IN (?, ?)
+        """, (TaskStatus.RUNNING.value, TaskStatus.CANCELLING.value))
+        row = cursor.fetchone()
+        return row[0], row[1]
+
+
+def get_usage_summary(db_path: str, task_id: int) -> Optional[UsageSummary]:
+    """汇总任务的资源使用采样，没有采样时返回None"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COUNT(*), MIN(sampled_at), MAX(sampled_at),
+                   MAX(cpu_percent), AVG(cpu_percent), MAX(rss_kb), AVG(rss_kb),
+                   MAX(read_bps), AVG(read_bps), MAX(write_bps), AVG(write_bps)
+            FROM task_usage WHERE task_id = ?
         """, (task_id,))
-        
         row = cursor.fetchone()
-        if row:
-            return Task(
-                id=row[0],
-                command=row[1],
-                working_dir=row[2],
-                status=TaskStatus(row[3]),
-                pid=row[4],
-                created_at=row[5],
-                started_at=row[6],
-                start_time=row[7],
-                completed_at=row[8],
-                exit_code=row[9]
-            )
-        return None
+        return UsageSummary(*row) if row[0] else None
 
 
-def get_task_by_pid(db_path: str, pid: int) -> Optional[Task]:
-    """根据PID获取任务"""
+def get_queue_limits(db_path: str) -> Dict[str, int]:
+    """获取设置了并发上限的队列"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT name, max_parallel FROM queues
+        """)
+        return dict(cursor.fetchall())
+
+
+def count_running_by_queue(db_path: str) -> Dict[str, int]:
+    """按队列统计占用槽位的任务数量（running以及正在终止的任务）"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT queue, COUNT(*) FROM tasks WHERE status IN (?, ?) GROUP BY queue
+        """, (TaskStatus.RUNNING.value, TaskStatus.CANCELLING.value))
+        return dict(cursor.fetchall())
+
+
+def get_queue_counts(db_path: str) -> Dict[str, Tuple[int, int]]:
+    """按队列统计运行中和待处理的任务数量"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT queue, status, COUNT(*) FROM tasks
+            WHERE status IN (?, ?) GROUP BY queue, status
+        """, (TaskStatus.RUNNING.value, TaskStatus.PENDING.value))
+        counts = {}
+        for queue, status, count in cursor.fetchall():
+            running, pending = counts.get(queue, (0, 0))
+            if status == TaskStatus.RUNNING.value:
+                running = count
+            else:
+                pending = count
+            counts[queue] = (running, pending)
+        return counts
+
+
+def get_cache_entry(db_path: str, key: str) -> Optional[Tuple[int, Optional[str]]]:
+    """根据缓存键查找缓存条目，返回产生结果的任务ID及其声明的输出，没有时返回None"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT task_id, outputs FROM task_cache WHERE key = ?
+        """, (key,))
+        return cursor.fetchone()
+
+
+def get_cache_stats(db_path: str) -> CacheStats:
+    """命令结果缓存的命中、未命中次数和条目数"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT
+                (SELECT value FROM settings WHERE key = 'cache_hits'),
+                (SELECT value FROM settings WHERE key = 'cache_misses'),
+                (SELECT COUNT(*) FROM task_cache)
+        """)
+        hits, misses, entries = cursor.fetchone()
+        return CacheStats(int(hits or 0), int(misses or 0), entries)
+
+
+def get_setting(db_path: str, key: str, default: Optional[str] = None) -> Optional[str]:
+    """读取全局设置"""
     with get_connection(db_path) as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT id, command, working_dir, status, pid, created_at, 
-                   started_at, start_time, completed_at, exit_code
-            FROM tasks 
-            WHERE pid = ?
-        """, (pid,))
-        
+            SELECT value FROM settings WHERE key = ?
+        """, (key,))
         row = cursor.fetchone()
-        if row:
-            return Task(
-                id=row[0],
-                command=row[1],
-                working_dir=row[2],
-                status=TaskStatus(row[3]),
-                pid=row[4],
-                created_at=row[5],
-                started_at=row[6],
-                start_time=row[7],
-                completed_at=row[8],
-                exit_code=row[9]
-            )
-        return None
+        return row[0] if row else default
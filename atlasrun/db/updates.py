@@ -1,43 +1,378 @@
 #!/usr/bin/env python3
 
 import time
+from typing import List, Optional, Sequence, Tuple
 from .models import TaskStatus
 from .connection import get_connection
 
 
-def add_task(db_path: str, command: str, working_dir: str) -> int:
-    """添加新任务到队列"""
+def _add_dependencies(cursor, task_ids: Sequence[int], depends_on: Sequence[int], now: float):
+    """写入依赖关系；依赖中已有失败或被取消的任务时，新任务直接标记为failed"""
+    if not depends_on:
+        return
+    cursor.executemany("""
+        INSERT OR IGNORE INTO task_deps (task_id, depends_on)
+        VALUES (?, ?)
+    """, [(task_id, dependency) for task_id in task_ids for dependency in depends_on])
+    placeholders = ",".join("?" * len(depends_on))
+    cursor.execute(f"""
+        SELECT COUNT(*) FROM tasks WHERE id IN ({placeholders}) AND status IN (?, ?, ?)
+    """, tuple(depends_on) + (TaskStatus.FAILED.value, TaskStatus.CANCELLED.value,
+                              TaskStatus.CANCELLING.value))
+    if cursor.fetchone()[0]:
+        cursor.executemany("""
+            UPDATE tasks SET status = ?, completed_at = ? WHERE id = ?
+        """, [(TaskStatus.FAILED.value, now, task_id) for task_id in task_ids])
+
+
+# 直接或间接依赖某个任务（参数）的所有任务ID，作为子查询使用，
+# 语句仍以UPDATE开头，cursor.rowcount才有效
+_DEPENDENTS_QUERY = """
+    WITH RECURSIVE dependents(id) AS (
+        SELECT task_id FROM task_deps WHERE depends_on = ?
+        UNION
+        SELECT task_deps.task_id FROM task_deps
+        JOIN dependents ON task_deps.depends_on = dependents.id
+    )
+    SELECT id FROM dependents
+"""
+
+
+def _fail_dependents(cursor, task_id: int, now: float, status: TaskStatus = TaskStatus.FAILED):
+    """任务失败（或被取消）后，所有直接或间接依赖它的待处理任务也标记为同样的状态"""
+    cursor.execute(f"""
+        UPDATE tasks SET status = ?, completed_at = ?
+        WHERE id IN ({_DEPENDENTS_QUERY}) AND status = ?
+    """, (status.value, now, task_id, TaskStatus.PENDING.value))
+
+
+def _retry_or_fail_dependents(cursor, task_id: int, now: float) -> TaskStatus:
+    """刚失败的任务还有重试次数时重新排队，否则依赖它的任务随之失败，返回任务的新状态
+
+    第n次重试前等待 backoff * 2^(n-1) 秒。没有经过claim_task而直接处于running的任务
+    （升级前遗留的running任务、--mark-running）运行次数为0，不视为可以重试。
+    """
+    cursor.execute("""
+        UPDATE tasks
+        SET status = ?, completed_at = NULL, pid = NULL, proc_start = NULL, boot_id = NULL,
+            next_eligible_at = ? + backoff * 1000 * (1 << MAX(attempts - 1, 0))
+        WHERE id = ? AND status = ? AND attempts >= 1 AND attempts <= max_retries
+    """, (TaskStatus.PENDING.value, now, task_id, TaskStatus.FAILED.value))
+    if cursor.rowcount == 1:
+        return TaskStatus.PENDING
+    _fail_dependents(cursor, task_id, now)
+    return TaskStatus.FAILED
+
+
+def add_task(db_path: str, command: str, working_dir: str, cpus: int = 1, mem_mb: int = 0,
+             depends_on: Sequence[int] = (), tag: Optional[str] = None,
+             queue: str = "default", priority: int = 0, max_retries: int = 0,
+             backoff: float = 0, timeout: Optional[float] = None, cache: bool = False,
+             inputs: Sequence[str] = (), outputs: Sequence[str] = ()) -> int:
+    """添加新任务到队列，depends_on中的任务全部成功后才会启动
+
+    失败后最多重试max_retries次，backoff为首次重试前的等待秒数，timeout为每次运行的时间上限（秒）。
+    cache为True时，输入未变且输出仍在的相同命令直接复用之前的结果。
+    """
+    now = time.time() * 1000
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO tasks (command, working_dir, status, created_at, cpus, mem_mb, tag,
+                               queue, priority, max_retries, backoff, timeout,
+                               cache, inputs, outputs)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (command, working_dir, TaskStatus.PENDING.value, now, cpus, mem_mb, tag,
+              queue, priority, max_retries, backoff, timeout,
+              cache, "\n".join(inputs) or None, "\n".join(outputs) or None))
+        task_id = cursor.lastrowid
+        _add_dependencies(cursor, [task_id], depends_on, now)
+        conn.commit()
+        return task_id
+
+
+def add_tasks(db_path: str, commands: List[str], working_dir: str,
+              cpus: int = 1, mem_mb: int = 0, depends_on: Sequence[int] = (),
+              tag: Optional[str] = None, queue: str = "default",
+              priority: int = 0, max_retries: int = 0, backoff: float = 0,
+              timeout: Optional[float] = None, cache: bool = False,
+              inputs: Sequence[str] = (), outputs: Sequence[str] = ()) -> Tuple[int, int]:
+    """在一个事务中批量添加任务，返回分配的首尾任务ID"""
+    created_at = time.time() * 1000
+    rows = [(command, working_dir, TaskStatus.PENDING.value, created_at, cpus, mem_mb, tag,
+             queue, priority, max_retries, backoff, timeout,
+             cache, "\n".join(inputs) or None, "\n".join(outputs) or None)
+            for command in commands]
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO tasks (command, working_dir, status, created_at, cpus, mem_mb, tag,
+                               queue, priority, max_retries, backoff, timeout,
+                               cache, inputs, outputs)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        # 同一写事务中插入的ID是连续的
+        last_id = cursor.execute("SELECT last_insert_rowid()").fetchone()[0]
+        first_id = last_id - len(rows) + 1
+        _add_dependencies(cursor, range(first_id, last_id + 1), depends_on, created_at)
+        conn.commit()
+        return first_id, last_id
+
+
+def update_pid(db_path: str, task_id: int, pid: int, proc_start: Optional[int] = None,
+               boot_id: Optional[str] = None):
+    """只更新running任务的PID（以及用于识别PID复用的进程启动时间和开机ID），不改变状态
+
+    runner启动后自己也会记录PID，已记录为其他进程的任务不会被覆盖。
+    """
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE tasks 
+            SET pid = ?, proc_start = ?, boot_id = ?
+            WHERE id = ? AND status = ? AND (pid IS NULL OR pid = ?)
+        """, (pid, proc_start, boot_id, task_id, TaskStatus.RUNNING.value, pid))
+        conn.commit()
+
+
+def claim_task(db_path: str, task_id: int) -> bool:
+    """将pending任务标记为running（仅当其仍处于pending状态时）并增加运行次数，返回是否成功"""
+    now = time.time() * 1000
     with get_connection(db_path) as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            INSERT INTO tasks (command, working_dir, status, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (command, working_dir, TaskStatus.PENDING.value, time.time() * 1000))
+            UPDATE tasks 
+            SET status = ?, started_at = ?, start_time = ?, attempts = attempts + 1
+            WHERE id = ? AND status = ?
+        """, (TaskStatus.RUNNING.value, now, now, task_id, TaskStatus.PENDING.value))
         conn.commit()
-        return cursor.lastrowid
+        return cursor.rowcount == 1
 
 
-def update_pid(db_path: str, task_id: int, pid: int):
-    """只更新任务的PID，不改变状态"""
+def complete_task(db_path: str, task_id: int, exit_code: int = 0):
+    """标记任务完成"""
     with get_connection(db_path) as conn:
         cursor = conn.cursor()
         cursor.execute("""
             UPDATE tasks 
-            SET pid = ?
+            SET status = ?, completed_at = ?, exit_code = ?
             WHERE id = ?
-        """, (pid, task_id))
+        """, (TaskStatus.COMPLETED.value, time.time() * 1000, exit_code, task_id))
+        conn.commit()
+
+
+def finish_task(db_path: str, task_id: int, pid: int, exit_code: int, user_time: float = None,
+                system_time: float = None, max_rss_kb: int = None) -> Optional[TaskStatus]:
+    """记录任务结束：退出码为0时标记为completed，否则为failed（还能重试时重新排队），
+    同时记录资源使用，返回任务的新状态
+
+    只更新仍由PID为pid的进程运行的任务；任务已被标记为丢失或已开始新一次运行时不做修改，返回None。
+    """
+    status = TaskStatus.COMPLETED if exit_code == 0 else TaskStatus.FAILED
+    now = time.time() * 1000
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        # 被终止（取消）的任务不重试，保持原状态，只记录退出码和资源使用；
+        # cancelling任务的进程全部退出后才标记为cancelled并释放槽位
+        cursor.execute("""
+            UPDATE tasks 
+            SET completed_at = ?, exit_code = ?, user_time = ?, system_time = ?, max_rss_kb = ?
+            WHERE id = ? AND status IN (?, ?) AND pid = ?
+        """, (now, exit_code, user_time, system_time, max_rss_kb,
+              task_id, TaskStatus.CANCELLING.value, TaskStatus.CANCELLED.value, pid))
+        if cursor.rowcount == 1:
+            conn.commit()
+            return TaskStatus.CANCELLED
+        cursor.execute("""
+            UPDATE tasks 
+            SET status = ?, completed_at = ?, exit_code = ?,
+                user_time = ?, system_time = ?, max_rss_kb = ?
+            WHERE id = ? AND status = ? AND pid = ?
+        """, (status.value, now, exit_code, user_time, system_time, max_rss_kb,
+              task_id, TaskStatus.RUNNING.value, pid))
+        if cursor.rowcount == 0:
+            conn.commit()
+            return None
+        if status == TaskStatus.FAILED:
+            status = _retry_or_fail_dependents(cursor, task_id, now)
+        else:
+            # 使用缓存的任务成功后记录结果，之后相同的命令可以直接复用
+            cursor.execute("""
+                INSERT OR REPLACE INTO task_cache (key, task_id, outputs, created_at, last_used_at)
+                SELECT cache_key, id, outputs, ?, ? FROM tasks
+                WHERE id = ? AND cache_key IS NOT NULL
+            """, (now, now, task_id))
         conn.commit()
+        return status
 
 
-def fail_task(db_path: str, task_id: int, exit_code: int):
-    """标记任务失败"""
+def mark_task_lost(db_path: str, task_id: int) -> bool:
+    """监管进程已消失而任务仍为running时标记为failed（退出码未知，还能重试时重新排队），返回是否更新"""
+    now = time.time() * 1000
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE tasks 
+            SET status = ?, completed_at = ?, exit_code = NULL,
+                user_time = NULL, system_time = NULL, max_rss_kb = NULL
+            WHERE id = ? AND status = ?
+        """, (TaskStatus.FAILED.value, now, task_id, TaskStatus.RUNNING.value))
+        lost = cursor.rowcount == 1
+        if lost:
+            _retry_or_fail_dependents(cursor, task_id, now)
+        conn.commit()
+        return lost
+
+
+def fail_task(db_path: str, task_id: int, exit_code: int) -> TaskStatus:
+    """标记任务失败（还能重试时重新排队），否则依赖它的任务也随之失败，返回任务的新状态"""
+    now = time.time() * 1000
     with get_connection(db_path) as conn:
         cursor = conn.cursor()
         cursor.execute("""
             UPDATE tasks 
             SET status = ?, completed_at = ?, exit_code = ?
             WHERE id = ?
-        """, (TaskStatus.FAILED.value, time.time() * 1000, exit_code, task_id))
+        """, (TaskStatus.FAILED.value, now, exit_code, task_id))
+        status = _retry_or_fail_dependents(cursor, task_id, now)
+        conn.commit()
+        return status
+
+
+def cancel_task(db_path: str, task_id: int) -> bool:
+    """取消pending或running任务（不再重试），依赖它的任务也随之取消，返回是否更新
+
+    已记录PID的running任务标记为cancelling，继续占用槽位和资源，
+    由终止它的进程确认所有进程退出后调用finish_cancel；其他任务直接标记为cancelled。
+    """
+    now = time.time() * 1000
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE tasks 
+            SET status = CASE WHEN status = ? AND pid IS NOT NULL THEN ? ELSE ? END,
+                completed_at = ?
+            WHERE id = ? AND status IN (?, ?)
+        """, (TaskStatus.RUNNING.value, TaskStatus.CANCELLING.value, TaskStatus.CANCELLED.value,
+              now, task_id, TaskStatus.PENDING.value, TaskStatus.RUNNING.value))
+        cancelled = cursor.rowcount == 1
+        if cancelled:
+            _fail_dependents(cursor, task_id, now, TaskStatus.CANCELLED)
+        conn.commit()
+        return cancelled
+
+
+def finish_cancel(db_path: str, task_id: int) -> bool:
+    """正在终止的任务的进程已全部退出：标记为cancelled，释放槽位和资源，返回是否更新"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE tasks 
+            SET status = ?, completed_at = ?
+            WHERE id = ? AND status = ?
+        """, (TaskStatus.CANCELLED.value, time.time() * 1000, task_id,
+              TaskStatus.CANCELLING.value))
+        conn.commit()
+        return cursor.rowcount == 1
+
+
+def requeue_task(db_path: str, task_id: int) -> bool:
+    """将已结束的任务重新排队为pending并重置运行次数，返回是否更新
+
+    任务写入的缓存条目被删除，重新排队后一定会再次运行。
+    因为它失败或被取消而从未启动过的下游任务也一并重新排队。
+    """
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE tasks 
+            SET status = ?, pid = NULL, proc_start = NULL, boot_id = NULL,
+                started_at = NULL, start_time = NULL, completed_at = NULL, exit_code = NULL,
+                user_time = NULL, system_time = NULL, max_rss_kb = NULL,
+                attempts = 0, next_eligible_at = NULL, cache_key = NULL, cached_from = NULL
+            WHERE id = ? AND status IN (?, ?, ?)
+        """, (TaskStatus.PENDING.value, task_id, TaskStatus.COMPLETED.value,
+              TaskStatus.FAILED.value, TaskStatus.CANCELLED.value))
+        requeued = cursor.rowcount == 1
+        if requeued:
+            # 任务自己写入的缓存条目也删除，否则重新运行时会直接复用自己上一次的结果
+            cursor.execute("""
+                DELETE FROM task_cache WHERE task_id = ?
+            """, (task_id,))
+        # 逐层恢复下游任务，仍依赖其他失败任务的保持原状态
+        while requeued:
+            cursor.execute(f"""
+                UPDATE tasks SET status = ?, completed_at = NULL
+                WHERE id IN ({_DEPENDENTS_QUERY}) AND status IN (?, ?)
+                AND started_at IS NULL AND NOT EXISTS (
+                    SELECT 1 FROM task_deps
+                    JOIN tasks AS dependency ON dependency.id = task_deps.depends_on
+                    WHERE task_deps.task_id = tasks.id AND dependency.status IN (?, ?)
+                )
+            """, (TaskStatus.PENDING.value, task_id, TaskStatus.FAILED.value,
+                  TaskStatus.CANCELLED.value, TaskStatus.FAILED.value,
+                  TaskStatus.CANCELLED.value))
+            if cursor.rowcount == 0:
+                break
+        conn.commit()
+        return requeued
+
+
+def _increment_counter(cursor, key: str):
+    """将settings中的计数加一"""
+    cursor.execute("""
+        INSERT OR IGNORE INTO settings (key, value) VALUES (?, 0)
+    """, (key,))
+    cursor.execute("""
+        UPDATE settings SET value = CAST(value AS INTEGER) + 1 WHERE key = ?
+    """, (key,))
+
+
+def complete_from_cache(db_path: str, task_id: int, source_task_id: int, key: str) -> bool:
+    """已认领的任务命中缓存：不运行直接标记为completed，记录复用的任务并更新缓存的使用时间"""
+    now = time.time() * 1000
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE tasks 
+            SET status = ?, completed_at = ?, exit_code = 0, cache_key = ?, cached_from = ?
+            WHERE id = ? AND status = ?
+        """, (TaskStatus.COMPLETED.value, now, key, source_task_id,
+              task_id, TaskStatus.RUNNING.value))
+        completed = cursor.rowcount == 1
+        if completed:
+            cursor.execute("""
+                UPDATE task_cache SET last_used_at = ? WHERE key = ?
+            """, (now, key))
+            _increment_counter(cursor, "cache_hits")
+        conn.commit()
+        return completed
+
+
+def record_cache_miss(db_path: str, task_id: int, key: Optional[str], max_entries: int):
+    """已认领的任务未命中缓存：记录缓存键以便成功后写入缓存，并按最近使用时间淘汰旧条目
+
+    key为None（输入文件不存在）时任务照常运行，但不写入缓存。
+    """
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        if key is not None:
+            cursor.execute("""
+                UPDATE tasks SET cache_key = ? WHERE id = ?
+            """, (key, task_id))
+            # 输出已被删除的旧条目不再有效
+            cursor.execute("""
+                DELETE FROM task_cache WHERE key = ?
+            """, (key,))
+            # 为这个任务的结果留出位置
+            cursor.execute("""
+                DELETE FROM task_cache WHERE key IN (
+                    SELECT key FROM task_cache
+                    ORDER BY last_used_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (max(max_entries - 1, 0),))
+        _increment_counter(cursor, "cache_misses")
         conn.commit()
 
 
@@ -77,13 +412,72 @@ def mark_task_running_by_pid(db_path: str, pid: int):
         conn.commit()
 
 
-def cleanup_completed_tasks(db_path: str, days: int = 7):
-    """清理已完成的任务（保留指定天数）"""
+def cleanup_completed_tasks(db_path: str, days: int = 7) -> List[int]:
+    """清理已完成的任务（保留指定天数），返回被删除的任务ID"""
     cutoff_time = time.time() * 1000 - (days * 24 * 3600 * 1000)
     with get_connection(db_path) as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            DELETE FROM tasks 
-            WHERE status IN (?, ?) AND completed_at < ?
-        """, (TaskStatus.COMPLETED.value, TaskStatus.FAILED.value, cutoff_time))
+            SELECT id FROM tasks 
+            WHERE status IN (?, ?, ?) AND completed_at < ?
+        """, (TaskStatus.COMPLETED.value, TaskStatus.FAILED.value, TaskStatus.CANCELLED.value,
+              cutoff_time))
+        task_ids = [row[0] for row in cursor.fetchall()]
+        cursor.executemany("""
+            DELETE FROM task_usage WHERE task_id = ?
+        """, [(task_id,) for task_id in task_ids])
+        # 已结束的依赖视为已满足，删除边不影响仍在等待的任务
+        cursor.executemany("""
+            DELETE FROM task_deps WHERE task_id = ? OR depends_on = ?
+        """, [(task_id, task_id) for task_id in task_ids])
+        cursor.executemany("""
+            DELETE FROM tasks WHERE id = ?
+        """, [(task_id,) for task_id in task_ids])
+        conn.commit()
+        return task_ids
+
+
+def add_usage_samples(db_path: str, samples):
+    """在一个事务中写入一批资源使用采样
+
+    samples中每项为 (task_id, sampled_at, cpu_percent, rss_kb, read_bps, write_bps)
+    """
+    with get_connection(db_path) as conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO task_usage
+                (task_id, sampled_at, cpu_percent, rss_kb, read_bps, write_bps)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, samples)
+
+
+def prune_usage_samples(db_path: str, before: float) -> int:
+    """删除早于指定时间（毫秒时间戳）的采样，返回删除数量"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM task_usage WHERE sampled_at < ?
+        """, (before,))
+        conn.commit()
+        return cursor.rowcount
+
+
+def set_queue_limit(db_path: str, name: str, max_parallel: int):
+    """设置队列的并发上限"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT OR REPLACE INTO queues (name, max_parallel)
+            VALUES (?, ?)
+        """, (name, max_parallel))
+        conn.commit()
+
+
+def set_setting(db_path: str, key: str, value: str):
+    """写入全局设置"""
+    with get_connection(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT OR REPLACE INTO settings (key, value)
+            VALUES (?, ?)
+        """, (key, str(value)))
         conn.commit()
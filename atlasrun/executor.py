@@ -1,252 +1,272 @@
 import os
 import subprocess
+import sys
 import time
 import signal
 from pathlib import Path
 from typing import Optional
 from .db import Database, Task, TaskStatus
-from .src.script_templates import create_task_script
+from .scheduler import Scheduler
+from .src.task_logs import open_task_logs, remove_task_logs
+from .src.processes import (
+    KILL_GRACE_PERIOD, get_task_processes, is_same_process, read_boot_id, read_process_start,
+    signal_task, terminate_orphaned_group
+)
 import sqlite3
 
 
+# 提交任务时显示的运行中任务数量
+RUNNING_PREVIEW = 10
+
+
+def exit_status_to_code(status: int) -> int:
+    """将wait返回的状态转换为退出码，被信号终止时返回负的信号编号"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def record_task_exit(db: Database, task_id: int, pid: int, status: int, rusage):
+    """根据wait4的结果记录任务的退出码和资源使用，返回退出码和任务的新状态
+
+    pid为数据库中记录的任务进程（runner或守护进程启动的bash）。
+    rusage包含任务的bash进程及其已回收的全部子进程；Linux下ru_maxrss的单位为KB。
+    失败的任务还能重试时新状态为pending；任务已不再由该进程运行时新状态为None。
+    """
+    exit_code = exit_status_to_code(status)
+    task_status = db.finish_task(task_id, pid, exit_code, rusage.ru_utime, rusage.ru_stime,
+                                 rusage.ru_maxrss)
+    return exit_code, task_status
+
+
 class TaskExecutor:
     def __init__(self, db: Database):
         self.db = db
         self.home_dir = Path.home()
         self.atlasrun_dir = self.home_dir / ".atlasrun"
+        # 旧版本为每个任务生成的临时脚本所在目录，现在只在清理任务时删除其中的脚本
         self.temp_scripts_dir = self.atlasrun_dir / "TEMP_script"
-        self.temp_scripts_dir.mkdir(exist_ok=True)
-    
-    def create_temp_script(self, command: str, task_id: int, working_dir: str, wait_for_pid: int = None) -> Path:
-        """创建临时bash脚本"""
-        # 创建日志目录
-        log_dir = self.atlasrun_dir / "logs"
-        log_dir.mkdir(exist_ok=True)
-        
-        script_content = create_task_script(
-            task_id=task_id,
-            command=command,
-            working_dir=working_dir,
-            temp_scripts_dir=self.temp_scripts_dir,
-            log_dir=log_dir,
-            wait_for_pid=wait_for_pid
-        )
-        
-        script_path = self.temp_scripts_dir / f"task_{task_id}.sh"
-        script_path.write_text(script_content)
-        script_path.chmod(0o755)
-        return script_path
-    
-    def wait_for_pid(self, pid: int, timeout: int = 300) -> bool:
-        """等待指定PID的进程结束"""
-        start_time = time.time()
-        while time.time() - start_time < timeout:
-            try:
-                # 检查进程是否还在运行
-                os.kill(pid, 0)
-                time.sleep(1)
-            except OSError:
-                # 进程已经结束
-                return True
-        return False
-    
-    def is_pid_running(self, pid: int) -> bool:
-        """检查PID是否还在运行"""
-        try:
-            os.kill(pid, 0)
-            return True
-        except OSError:
-            return False
-    
-    def wait_for_running_tasks(self) -> None:
-        """等待所有正在运行的任务完成"""
-        while True:
-            running_tasks = self.db.get_running_tasks()
-            if not running_tasks:
-                break
-            
-            # 检查每个运行中的任务
-            for task in running_tasks:
-                if task.pid and not self.is_pid_running(task.pid):
-                    # 进程已经结束，更新状态
-                    self.db.complete_task(task.id, 0)  # 假设正常退出
-                    print(f"Task {task.id} completed")
-            
-            # 等待一秒后再次检查
-            time.sleep(1)
     
     def update_task_statuses(self) -> None:
-        """更新所有运行中任务的状态，检查PID是否还在运行"""
+        """更新所有运行中任务的状态：监管进程已不存在（或PID已被复用）的任务标记为失败"""
         running_tasks = self.db.get_all_running_tasks()
-        updated_count = 0
         
         if not running_tasks:
             print("No running tasks found")
             return
         
         print(f"Checking {len(running_tasks)} running tasks...")
-        
+        scheduler = Scheduler(self.db, self)
+        lost = scheduler.recover_orphans()
         for task in running_tasks:
-            if task.pid and not self.is_pid_running(task.pid):
-                # 进程已经结束，更新状态为completed
-                # 尝试从日志获取退出码
-                exit_code = 0  # 默认假设成功
-                try:
-                    log_dir = self.atlasrun_dir / "logs"
-                    stderr_log = log_dir / f"task_{task.id}.err"
-                    if stderr_log.exists():
-                        # 从日志中提取退出码
-                        content = stderr_log.read_text()
-                        if "exit code" in content:
-                            # 简单解析退出码
-                            lines = content.split('\n')
-                            for line in lines:
-                                if "exit code" in line:
-                                    try:
-                                        exit_code = int(line.split()[-1])
-                                        break
-                                    except:
-                                        pass
-                except:
-                    pass
-                
-                self.db.complete_task(task.id, exit_code)
-                print(f"Task {task.id} completed with exit code {exit_code}")
-                updated_count += 1
+            if task.id in lost:
+                # 监管进程已不存在却没有记录退出码（例如被强制终止或机器重启），
+                # 真实退出码已无法得知，标记为失败或按重试设置重新排队
+                if self.db.get_task_by_id(task.id).status == TaskStatus.PENDING:
+                    print(f"Task {task.id} (PID: {task.pid}) exited without recording an exit code, queued for retry")
+                else:
+                    print(f"Task {task.id} (PID: {task.pid}) exited without recording an exit code, marked as failed")
             else:
                 print(f"Task {task.id} (PID: {task.pid}) is still running")
         
-        # 检查是否有pending任务可以开始运行
-        pending_tasks = self.db.get_pending_tasks()
-        if pending_tasks and not running_tasks:
-            # 没有运行中的任务，可以启动第一个pending任务
-            next_task = pending_tasks[0]
-            print(f"Starting next pending task: {next_task.id}")
-            # 这里可以启动任务，但为了避免循环调用，我们只是标记状态
-            # 实际的任务启动会在脚本执行时通过arun -u触发
-        
-        if updated_count > 0:
-            print(f"Updated {updated_count} task(s)")
+        if lost:
+            print(f"Updated {len(lost)} task(s)")
         else:
             print("No tasks to update")
+        
+        # 释放出的槽位交给等待中的任务
+        for task_id in scheduler.request_dispatch() or []:
+            print(f"Started pending task {task_id}")
     
-    def execute_task(self, task: Task, wait_for_pid: int = None) -> bool:
-        """执行指定任务"""
+    def cancel_tasks(self, task_ids, kill: bool = False) -> None:
+        """取消任务，依赖它们的待处理任务随之取消，然后调度等待中的任务
+
+        kill为True时同时终止运行中的任务：整个进程组先收到SIGTERM，
+        KILL_GRACE_PERIOD秒后仍未退出的进程收到SIGKILL。终止期间任务处于cancelling状态，
+        继续占用槽位和预留的资源，进程全部退出后才标记为cancelled并调度下一个任务。
+        """
+        terminating = []
+        for task_id in task_ids:
+            task = self.db.get_task_by_id(task_id)
+            if task is None:
+                print(f"Task {task_id} not found")
+                continue
+            if task.status == TaskStatus.RUNNING and not kill:
+                print(f"Task {task_id} is running, use --kill to terminate it")
+                continue
+            # 先标记为cancelling，监管进程记录退出码时不会再按失败重试
+            if not self.db.cancel_task(task_id):
+                print(f"Task {task_id} is already {task.status.value}")
+                continue
+            if task.status != TaskStatus.RUNNING or task.pid is None:
+                print(f"Task {task_id} cancelled")
+                continue
+            if is_same_process(task.pid, task.proc_start, task.boot_id):
+                signal_task(task.pid, signal.SIGTERM)
+            else:
+                terminate_orphaned_group(task.pid, task.boot_id)
+            terminating.append(task)
+        
+        deadline = time.monotonic() + KILL_GRACE_PERIOD
+        while terminating:
+            alive = [task for task in terminating if get_task_processes(task.pid)]
+            for task in terminating:
+                if task not in alive:
+                    self.db.finish_cancel(task.id)
+                    print(f"Task {task.id} terminated")
+            terminating = alive
+            if not terminating or time.monotonic() >= deadline:
+                break
+            time.sleep(0.1)
+        for task in terminating:
+            for pid in get_task_processes(task.pid):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            # SIGKILL无法被忽略，进程随即释放占用的资源
+            self.db.finish_cancel(task.id)
+            print(f"Task {task.id} killed after ignoring SIGTERM for {KILL_GRACE_PERIOD}s")
+        
+        for task_id in Scheduler(self.db, self).request_dispatch() or []:
+            print(f"Started pending task {task_id}")
+    
+    def requeue_tasks(self, task_ids) -> None:
+        """将已结束的任务（及因其失败而未能运行的下游任务）重新排队，然后调度"""
+        for task_id in task_ids:
+            task = self.db.get_task_by_id(task_id)
+            if task is None:
+                print(f"Task {task_id} not found")
+            elif not self.db.requeue_task(task_id):
+                print(f"Task {task_id} is {task.status.value}, nothing to requeue")
+            else:
+                # 重新运行的输出写入新的日志，旧日志会被覆盖，直接删除
+                remove_task_logs([task_id])
+                print(f"Task {task_id} requeued")
+        
+        for task_id in Scheduler(self.db, self).request_dispatch() or []:
+            print(f"Started pending task {task_id}")
+    
+    def execute_task(self, task: Task) -> bool:
+        """执行指定任务（调用前任务应已被调度器认领为running）"""
         try:
-            # 创建临时脚本
-            script_path = self.create_temp_script(task.command, task.id, task.working_dir, wait_for_pid)
-            
-            # 使用nohup在后台启动进程
-            pid_file = self.temp_scripts_dir / f"task_{task.id}.pid"
-            os.system(f"nohup bash {script_path} > /dev/null 2>&1 & echo $! > {pid_file}")
-            
-            # 读取PID
-            try:
-                with open(pid_file, 'r') as f:
-                    pid = int(f.read().strip())
-                # 删除PID文件
-                pid_file.unlink()
-            except:
-                # 如果无法获取PID，使用一个虚拟PID
-                pid = os.getpid() + task.id  # 简单的虚拟PID生成
-            
-            # 记录PID，但状态保持为pending，等待脚本自己更新
-            # 这里我们只更新PID，不改变状态
-            self.db.update_pid(task.id, pid)
-            
-            print(f"Task {task.id} started with PID {pid} (status: pending)")
-            
-            return True
-            
+            process = self.spawn_task(task)
         except Exception as e:
             print(f"Error executing task {task.id}: {e}")
             self.db.fail_task(task.id, -1)
             return False
+        
+        print(f"Task {task.id} started with PID {process.pid}")
+        return True
     
-    def process_queue(self) -> None:
-        """处理任务队列"""
-        while True:
-            # 等待所有运行中的任务完成
-            self.wait_for_running_tasks()
-            
-            # 获取下一个待处理任务
-            pending_tasks = self.db.get_pending_tasks()
-            if not pending_tasks:
-                print("No pending tasks")
-                break
-            
-            # 执行下一个任务
-            next_task = pending_tasks[0]
-            print(f"Executing task {next_task.id}: {next_task.command}")
-            
-            if not self.execute_task(next_task):
-                print(f"Failed to execute task {next_task.id}")
-                break
-            
-            # 短暂休息，避免过于频繁的检查
-            time.sleep(1)
+    def remove_task_files(self, task_ids) -> int:
+        """删除任务的日志（以及旧版本留下的临时脚本），返回删除的文件数"""
+        removed = remove_task_logs(task_ids)
+        for task_id in task_ids:
+            try:
+                (self.temp_scripts_dir / f"task_{task_id}.sh").unlink()
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
     
-    def run_single_task(self, command: str, working_dir: str = None) -> int:
+    def spawn_task(self, task: Task, with_runner: bool = True) -> subprocess.Popen:
+        """在新会话中启动任务并记录真实PID
+
+        默认由runner进程从数据库读取命令并监管任务、记录退出码；with_runner为False时
+        直接用 bash -c 在工作目录中执行命令，由调用方（调度守护进程）作为父进程回收任务并记录退出码。
+        命令作为参数原样传给bash，不写入任何脚本文件。
+        """
+        if with_runner:
+            process = subprocess.Popen(
+                [sys.executable, "-m", "atlasrun.runner", str(task.id)],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True
+            )
+        else:
+            with open_task_logs(task.id) as (stdout_log, stderr_log):
+                process = subprocess.Popen(
+                    ["bash", "-c", task.command],
+                    cwd=task.working_dir,
+                    stdin=subprocess.DEVNULL,
+                    stdout=stdout_log,
+                    stderr=stderr_log,
+                    start_new_session=True
+                )
+        
+        # 状态已由调度器设置为running，这里只记录PID及其启动时间
+        self.db.update_pid(task.id, process.pid, read_process_start(process.pid), read_boot_id())
+        return process
+    
+    def run_single_task(self, command: str, working_dir: str = None, cpus: int = 1, mem_mb: int = 0,
+                        depends_on=(), tag: str = None, queue: str = "default",
+                        priority: int = 0, max_retries: int = 0, backoff: float = 0,
+                        timeout: float = None, cache: bool = False, inputs=(),
+                        outputs=()) -> int:
         """运行单个任务（用于命令行接口）"""
         if working_dir is None:
             working_dir = os.getcwd()
         
-        # 先检查并显示当前运行中的任务
-        running_tasks = self.db.get_running_tasks()
+        # 先显示最早的几个运行中任务，运行中任务很多时不全部读取
+        running_tasks = self.db.get_running_tasks(limit=RUNNING_PREVIEW)
         if running_tasks:
             print(f"Currently running tasks:")
             for task in running_tasks:
                 print(f"  Task {task.id}: {task.command} (PID: {task.pid})")
+            if len(running_tasks) == RUNNING_PREVIEW:
+                running_count = self.db.count_running_tasks()
+                if running_count > RUNNING_PREVIEW:
+                    print(f"  ... and {running_count - RUNNING_PREVIEW} more")
             print()
         
         # 添加任务到队列
-        task_id = self.db.add_task(command, working_dir)
+        task_id = self.db.add_task(command, working_dir, cpus, mem_mb, depends_on, tag,
+                                   queue, priority, max_retries, backoff, timeout,
+                                   cache, inputs, outputs)
         print(f"Task {task_id} added to queue: {command}")
+        if depends_on:
+            print(f"Task {task_id} runs after task(s) {', '.join(map(str, depends_on))} succeed")
         
-        # 获取队列中所有任务（包括pending和running），按提交时间排序
-        all_tasks = self.db.get_all_tasks(limit=1000)  # 获取足够多的任务
+        # 有空闲槽位时立即启动，否则等待运行中的任务结束后由调度器启动
+        started = Scheduler(self.db, self).request_dispatch()
         
-        # 找到当前任务之前最新提交的任务
-        current_task = None
-        previous_task = None
+        if started is None:
+            print(f"Task {task_id} handed over to the scheduler daemon")
+        elif task_id in started:
+            print(f"Task {task_id} started in background")
+        else:
+            task = self.db.get_task_by_id(task_id)
+            if task.cached_from is not None:
+                print(f"Task {task_id} skipped: inputs unchanged, reusing the result of task {task.cached_from}")
+            elif depends_on and task.status == TaskStatus.FAILED:
+                print(f"Task {task_id} failed: a task it depends on has failed")
+            elif depends_on:
+                print(f"Task {task_id} queued, waiting for its dependencies")
+            else:
+                print(f"Task {task_id} queued, waiting for a free slot or resources "
+                      f"({self.db.count_running_tasks()}/{self.db.get_max_parallel()} running)")
         
-        for task in all_tasks:
-            if task.id == task_id:
-                current_task = task
-                break
-            previous_task = task
+        return task_id
+    
+    def run_batch(self, commands, working_dir: str = None, cpus: int = 1, mem_mb: int = 0,
+                  depends_on=(), tag: str = None, queue: str = "default", priority: int = 0,
+                  max_retries: int = 0, backoff: float = 0, timeout: float = None,
+                  cache: bool = False, inputs=(), outputs=()):
+        """批量提交任务并触发一次调度，返回分配的首尾任务ID"""
+        if working_dir is None:
+            working_dir = os.getcwd()
         
-        # 确定需要等待的PID和任务状态
-        wait_for_pid = None
-        should_start_immediately = previous_task is None
+        first_id, last_id = self.db.add_tasks(commands, working_dir, cpus, mem_mb, depends_on, tag,
+                                              queue, priority, max_retries, backoff, timeout,
+                                              cache, inputs, outputs)
+        print(f"Added {len(commands)} task(s) to queue: IDs {first_id}-{last_id}")
         
-        if previous_task:
-            # 等待前一个任务完成（不管它是什么状态）
-            wait_for_pid = previous_task.pid
-            print(f"Task {task_id} will wait for task {previous_task.id} (PID: {wait_for_pid}, status: {previous_task.status.value}) to complete")
+        started = Scheduler(self.db, self).request_dispatch()
+        if started is None:
+            print("Tasks handed over to the scheduler daemon")
         else:
-            print(f"No previous tasks, starting task {task_id} immediately")
-        
-        print(f"DEBUG: wait_for_pid = {wait_for_pid}")
-        
-        # 启动任务
-        print(f"Starting task {task_id}...")
-        self.execute_task(Task(
-            id=task_id,
-            command=command,
-            working_dir=working_dir, 
-            status=TaskStatus.PENDING,
-            pid=None,
-            created_at=time.time() * 1000,
-            started_at=None,
-            start_time=None,
-            completed_at=None,
-            exit_code=None
-        ), wait_for_pid)
-        
-        if should_start_immediately:
-            print(f"Task {task_id} started in background")
-        else:
-            print(f"Task {task_id} queued, waiting for previous task to complete")
+            print(f"Started {len(started)} task(s), {len(commands) - len(started)} waiting for a free slot")
         
-        return task_id
+        return first_id, last_id
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Task runner for AtlasRun
+
+没有调度守护进程时，每个任务由一个runner进程监管：
+    python -m atlasrun.runner <task_id>
+runner从数据库读取任务的命令和工作目录，用 bash -c 执行命令并作为其父进程通过wait4
+等待其结束，直接在数据库中记录真实的退出码和CPU时间、峰值内存，然后启动下一个等待中的任务。
+任务设置了超时时由runner终止超时的任务；失败后按重试设置重新排队时，没有守护进程的情况下
+由runner等到退避时间结束后再次调度。
+"""
+import os
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .db import Database, TaskStatus
+from .executor import TaskExecutor, record_task_exit
+from .scheduler import Scheduler
+from .src.processes import KILL_GRACE_PERIOD, read_boot_id, read_process_start, signal_task
+from .src.task_logs import open_task_logs, rotate_task_logs, finalize_task_logs, enforce_log_quota
+
+# 任务运行期间检查日志大小的间隔（秒）
+LOG_CHECK_INTERVAL = 10
+
+
+def rotate_logs(db: Database, task_id: int, policy) -> None:
+    """轮转任务过大的日志，有日志被轮转时检查配额，长时间运行的任务不会等到结束才受配额限制"""
+    try:
+        if rotate_task_logs(task_id, policy):
+            enforce_log_quota(policy, db.get_log_writer_ids())
+    except Exception as e:
+        print(f"Error rotating logs of task {task_id}: {e}", file=sys.stderr)
+
+
+def wait_for_task(db: Database, process: subprocess.Popen, task_id: int, policy,
+                  log_worker: ThreadPoolExecutor, timeout: float = None):
+    """等待任务结束并返回wait4的结果，期间定期在log_worker中轮转日志
+
+    压缩轮转出的分段较慢，放到后台线程中进行，不推迟超时处理和退出码的记录。
+    运行超过timeout秒时向任务的所有进程发送SIGTERM，KILL_GRACE_PERIOD秒后仍未退出则发送SIGKILL。
+    """
+    if not policy.rotate_mb and not timeout:
+        return os.wait4(process.pid, 0)
+
+    now = time.monotonic()
+    next_rotate_at = now if policy.rotate_mb else None
+    deadline = now + timeout if timeout else None
+    terminated = False
+    rotation = None
+    # 阻塞SIGCHLD后用sigtimedwait等待，任务结束时立即返回，否则定期检查日志和超时
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGCHLD])
+    try:
+        while True:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                if terminated:
+                    # 超时的任务不留下任何进程
+                    signal_task(os.getpid(), signal.SIGKILL)
+                return pid, status, rusage
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                if terminated:
+                    signal_task(os.getpid(), signal.SIGKILL)
+                    deadline = None
+                else:
+                    signal_task(os.getpid(), signal.SIGTERM)
+                    terminated = True
+                    deadline = now + KILL_GRACE_PERIOD
+                continue
+            if next_rotate_at is not None and now >= next_rotate_at:
+                # 后台线程继承阻塞SIGCHLD的信号掩码，SIGCHLD仍由这里的sigtimedwait接收
+                if rotation is None or rotation.done():
+                    rotation = log_worker.submit(rotate_logs, db, task_id, policy)
+                next_rotate_at = now + LOG_CHECK_INTERVAL
+            waits = [at - now for at in (next_rotate_at, deadline) if at is not None]
+            if not waits:
+                # 已发送SIGKILL且不需要轮转日志，直接等待任务结束
+                return os.wait4(process.pid, 0)
+            signal.sigtimedwait([signal.SIGCHLD], max(min(waits), 0))
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGCHLD])
+
+
+def run_task(db: Database, task_id: int) -> int:
+    """运行任务直到结束，记录退出码并触发下一次调度，返回退出码"""
+    executor = TaskExecutor(db)
+
+    # 终止整个进程组时runner需要存活到记录完退出码；
+    # 处理函数在exec时会恢复为默认行为，不影响任务本身
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: None)
+
+    policy = db.get_log_policy()
+    log_worker = ThreadPoolExecutor(max_workers=1)
+    try:
+        return supervise_task(db, executor, task_id, policy, log_worker)
+    finally:
+        log_worker.shutdown(wait=True)
+
+
+def supervise_task(db: Database, executor: TaskExecutor, task_id: int, policy,
+                   log_worker: ThreadPoolExecutor) -> int:
+    """启动任务并等待其结束，记录退出码、调度下一个任务并压缩日志，返回退出码"""
+    task = db.get_task_by_id(task_id)
+    if task is None or task.status != TaskStatus.RUNNING:
+        # 认领后、启动前已被取消
+        return -1
+    # 启动runner的进程也会记录PID，但任务可能在那之前就已结束；结束时只更新记录为本进程的任务
+    db.update_pid(task_id, os.getpid(), read_process_start(os.getpid()), read_boot_id())
+    try:
+        with open_task_logs(task_id) as (stdout_log, stderr_log):
+            process = subprocess.Popen(
+                ["bash", "-c", task.command],
+                cwd=task.working_dir,
+                stdin=subprocess.DEVNULL,
+                stdout=stdout_log,
+                stderr=stderr_log
+            )
+    except OSError as e:
+        print(f"Error starting task {task_id}: {e}", file=sys.stderr)
+        task_status = db.fail_task(task_id, -1)
+        exit_code = -1
+    else:
+        # 用wait4代替process.wait()，同时取得任务的资源使用
+        _, status, rusage = wait_for_task(db, process, task_id, policy, log_worker,
+                                          task.timeout)
+        exit_code, task_status = record_task_exit(db, task_id, os.getpid(), status, rusage)
+        process.returncode = exit_code
+        if task_status is None:
+            print(f"Task {task_id} is no longer run by this runner, exit code {exit_code} "
+                  f"not recorded", file=sys.stderr)
+            return exit_code
+    # 重新运行的任务会继续写入同一个日志，等正在进行的轮转完成后再调度
+    log_worker.shutdown(wait=True)
+
+    # 释放的槽位交给下一个任务，然后再压缩日志
+    scheduler = Scheduler(db, executor)
+    daemon_running = scheduler.request_dispatch() is None
+    if task_status == TaskStatus.PENDING:
+        # 下一次运行继续追加写入同一个日志，因此暂不压缩；等待重试的任务在退避时间内
+        # 不会被调度，没有守护进程时由runner等到退避结束后再调度一次
+        if not daemon_running:
+            retry_at = db.get_task_by_id(task_id).next_eligible_at
+            if retry_at:
+                time.sleep(max(retry_at / 1000 - time.time(), 0))
+            scheduler.request_dispatch()
+        return exit_code
+    finalize_task_logs(task_id, policy)
+    enforce_log_quota(policy, db.get_log_writer_ids())
+    return exit_code
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1 or not argv[0].isdigit():
+        print("Usage: python -m atlasrun.runner <task_id>", file=sys.stderr)
+        return 2
+    run_task(Database(ensure_schema=False), int(argv[0]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Resource usage sampler for AtlasRun
+
+定期读取 /proc 采集每个运行中任务的CPU、内存和读写速率，写入 task_usage 表。
+任务都在以其PID为会话ID的新会话中启动，因此会话ID等于数据库中记录的PID的进程
+即为该任务的进程树；监管任务的runner进程本身不计入。
+"""
+import os
+import signal
+import time
+from typing import Dict, List, Optional, Tuple
+from .db import Database
+from .src.processes import is_runner_process
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+
+# 独立运行（arun --sampler）且未配置采样间隔时使用的间隔（秒）
+STANDALONE_SAMPLE_INTERVAL = 10
+
+# 清理过期采样的间隔（秒）
+PRUNE_INTERVAL = 3600
+
+
+def read_proc_stat(pid: int) -> Optional[Tuple[int, int, int]]:
+    """读取 /proc/<pid>/stat，返回 (会话ID, CPU时钟数, RSS KB)，进程不存在时返回None
+
+    CPU时钟数包括进程已回收的子进程，避免短命子进程退出后CPU时间丢失。
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    # 进程名可能包含空格和括号，从最后一个右括号之后开始解析
+    fields = data[data.rindex(b")") + 2:].split()
+    cpu_ticks = int(fields[11]) + int(fields[12]) + int(fields[13]) + int(fields[14])
+    return int(fields[3]), cpu_ticks, int(fields[21]) * PAGE_KB
+
+
+def read_proc_io(pid: int) -> Tuple[int, int]:
+    """读取 /proc/<pid>/io 中的实际磁盘读写字节数，无权限或进程已退出时返回0"""
+    read_bytes = write_bytes = 0
+    try:
+        with open(f"/proc/{pid}/io", "rb") as f:
+            for line in f:
+                if line.startswith(b"read_bytes:"):
+                    read_bytes = int(line.split()[1])
+                elif line.startswith(b"write_bytes:"):
+                    write_bytes = int(line.split()[1])
+    except OSError:
+        pass
+    return read_bytes, write_bytes
+
+
+class UsageSampler:
+    """采集运行中任务的资源使用"""
+
+    def __init__(self, db: Database):
+        self.db = db
+        # 任务ID -> 上一次采样的 (时间, CPU时钟数, 读字节数, 写字节数)
+        self.previous: Dict[int, Tuple[float, int, int, int]] = {}
+        # 会话首进程PID -> 是否为runner，避免每次采样都读取cmdline
+        self.runners: Dict[int, bool] = {}
+        self.last_prune = 0.0
+
+    def collect(self) -> int:
+        """对所有运行中任务采样一次并写入数据库，返回采样的任务数"""
+        tasks = {task.pid: task for task in self.db.get_all_running_tasks() if task.pid}
+        self.runners = {pid: self.runners.get(pid) for pid in tasks}
+        if not tasks:
+            self.previous.clear()
+            return 0
+
+        # 每个任务的 [CPU时钟数, RSS KB, 读字节数, 写字节数]
+        totals: Dict[int, List[int]] = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            pid = int(name)
+            stat = read_proc_stat(pid)
+            if stat is None or stat[0] not in tasks:
+                continue
+            session = stat[0]
+            if pid == session:
+                if self.runners[pid] is None:
+                    self.runners[pid] = is_runner_process(pid)
+                if self.runners[pid]:
+                    continue
+            read_bytes, write_bytes = read_proc_io(pid)
+            total = totals.setdefault(session, [0, 0, 0, 0])
+            total[0] += stat[1]
+            total[1] += stat[2]
+            total[2] += read_bytes
+            total[3] += write_bytes
+
+        now = time.time()
+        samples = []
+        previous = {}
+        for session, (cpu_ticks, rss_kb, read_bytes, write_bytes) in totals.items():
+            task = tasks[session]
+            # 任务的第一次采样按开始运行以来的平均值计算
+            last = self.previous.get(task.id)
+            if last is None and task.start_time:
+                last = (task.start_time / 1000, 0, 0, 0)
+            if last is not None and now > last[0]:
+                elapsed = now - last[0]
+                cpu_percent = max(cpu_ticks - last[1], 0) / CLOCK_TICKS / elapsed * 100
+                read_bps = max(read_bytes - last[2], 0) / elapsed
+                write_bps = max(write_bytes - last[3], 0) / elapsed
+            else:
+                cpu_percent = read_bps = write_bps = 0.0
+            previous[task.id] = (now, cpu_ticks, read_bytes, write_bytes)
+            samples.append((task.id, now * 1000, cpu_percent, rss_kb, read_bps, write_bps))
+        self.previous = previous
+
+        if samples:
+            self.db.add_usage_samples(samples)
+        return len(samples)
+
+    def prune(self, force: bool = False) -> int:
+        """按保留时长删除过期采样（默认每小时最多执行一次），返回删除数量"""
+        now = time.time()
+        if not force and now - self.last_prune < PRUNE_INTERVAL:
+            return 0
+        self.last_prune = now
+        return self.db.prune_usage_samples((now - self.db.get_sample_retention()) * 1000)
+
+    def sample(self) -> int:
+        """采样一次并按需清理过期采样"""
+        count = self.collect()
+        self.prune()
+        return count
+
+    def run(self) -> None:
+        """在前台持续采样，直到收到SIGTERM或SIGINT"""
+        interval = self.db.get_sample_interval() or STANDALONE_SAMPLE_INTERVAL
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        print(f"Usage sampler started with PID {os.getpid()}, interval {interval:g}s", flush=True)
+        try:
+            while True:
+                started = time.monotonic()
+                self.sample()
+                time.sleep(max(interval - (time.monotonic() - started), 0))
+        except KeyboardInterrupt:
+            pass
+        print("Usage sampler stopped", flush=True)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Task scheduler for AtlasRun
+"""
+import os
+import signal
+import time
+from pathlib import Path
+from typing import Iterator, List, Optional
+from .db import Database, Task
+from .src.processes import (
+    get_task_processes, is_same_process, read_boot_id, terminate_orphaned_group
+)
+from .src.task_cache import compute_cache_key, outputs_exist
+
+# 每次调度最多检查的待处理任务数，用于小任务回填
+BACKFILL_WINDOW = 1000
+
+# 已认领但超过这个时间（秒）仍未记录PID的任务视为启动失败
+CLAIM_GRACE_PERIOD = 60
+
+# 通知调度守护进程有新的调度工作
+WAKEUP_SIGNAL = signal.SIGUSR1
+
+
+def get_daemon_pid_file(db: Database) -> Path:
+    """调度守护进程的PID文件，与数据库放在同一目录"""
+    return Path(db.db_path).parent / "daemon.pid"
+
+
+def get_daemon_pid(db: Database) -> Optional[int]:
+    """返回正在运行的调度守护进程PID，没有则返回None"""
+    try:
+        pid = int(get_daemon_pid_file(db).read_text().strip())
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return None
+    # PID可能已被其他进程复用，确认它确实是守护进程
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            if b"--daemon" not in f.read():
+                return None
+    except OSError:
+        pass
+    return pid
+
+
+def notify_daemon(db: Database) -> bool:
+    """唤醒正在运行的调度守护进程，没有守护进程时返回False"""
+    daemon_pid = get_daemon_pid(db)
+    if daemon_pid is None:
+        return False
+    try:
+        os.kill(daemon_pid, WAKEUP_SIGNAL)
+        return True
+    except OSError:
+        return False
+
+
+class Scheduler:
+    """在空闲的并发槽位和主机资源内启动待处理任务"""
+
+    def __init__(self, db: Database, executor):
+        self.db = db
+        self.executor = executor
+
+    def free_slots(self) -> int:
+        """计算当前空闲的并发槽位数量"""
+        return max(0, self.db.get_max_parallel() - self.db.count_running_tasks())
+
+    def recover_orphans(self) -> List[int]:
+        """将监管进程已经不存在的running任务标记为失败，返回这些任务的ID
+
+        PID被复用（启动时间不同）或机器已重启（开机ID不同）的任务同样视为已丢失，
+        这样队列不会因为残留的running任务占用槽位而卡住。
+        进程已全部退出的cancelling任务标记为cancelled。
+        """
+        lost = []
+        now = time.time() * 1000
+        for task in self.db.get_all_running_tasks():
+            if task.pid is None:
+                # 刚被认领、正在启动的任务还没有PID
+                if task.started_at and now - task.started_at < CLAIM_GRACE_PERIOD * 1000:
+                    continue
+            elif is_same_process(task.pid, task.proc_start, task.boot_id):
+                continue
+            if self.db.mark_task_lost(task.id):
+                lost.append(task.id)
+                # 监管进程被强制终止时任务本身可能还在运行，终止它以免超出并发上限
+                if task.pid is not None:
+                    terminate_orphaned_group(task.pid, task.boot_id)
+        # 终止任务的进程（arun --kill）被中断、没有等到任务的进程全部退出时，在这里释放槽位
+        for task in self.db.get_cancelling_tasks():
+            if task.boot_id is not None and task.boot_id != read_boot_id():
+                self.db.finish_cancel(task.id)
+            elif not get_task_processes(task.pid):
+                self.db.finish_cancel(task.id)
+        return lost
+
+    def ready_tasks(self, slots: int, full_queues: List[str]) -> Iterator[Task]:
+        """按调度顺序逐个返回可以启动的任务
+
+        通常最前面的slots个任务就能填满空闲槽位，只读取这几行；
+        其中有任务放不下时才继续读取整个回填窗口。
+        """
+        first = self.db.get_ready_tasks(slots, full_queues)
+        yield from first
+        if len(first) < slots:
+            return
+        seen = {task.id for task in first}
+        for task in self.db.get_ready_tasks(BACKFILL_WINDOW, full_queues):
+            if task.id not in seen:
+                yield task
+
+    def dispatch(self) -> List[int]:
+        """按优先级和入队顺序启动依赖已满足且能放进剩余资源的待处理任务，返回本次启动的任务ID
+
+        启动前先回收已丢失的running任务占用的槽位。已达到并发上限的队列被跳过，不会挡住其他队列的任务；
+        放不下的大任务不会阻塞后面的小任务，小任务会回填空闲的CPU和内存。
+        命中缓存的任务不运行，它们释放的槽位和满足的依赖在同一次调度中继续使用。
+        """
+        started = []
+        self.recover_orphans()
+        while True:
+            reused = 0
+            for task in self.claim_tasks():
+                if task.cache and self.reuse_cached_result(task):
+                    reused += 1
+                elif self.executor.execute_task(task):
+                    started.append(task.id)
+            if not reused:
+                return started
+
+    def reuse_cached_result(self, task: Task) -> bool:
+        """已认领的任务有可用的缓存结果时直接标记为完成，返回是否命中"""
+        key = compute_cache_key(task)
+        if key is not None:
+            entry = self.db.get_cache_entry(key)
+            if entry is not None and outputs_exist(task.working_dir, entry[1]):
+                if self.db.complete_from_cache(task.id, entry[0], key):
+                    return True
+        self.db.record_cache_miss(task.id, key)
+        return False
+
+    def claim_tasks(self) -> List[Task]:
+        """在一个写事务中检查空闲槽位和资源并认领任务，返回认领的任务
+
+        多个进程同时调度时依次执行，不会超出并发上限或重复认领同一个任务。
+        """
+        claimed = []
+        with self.db.transaction():
+            slots = self.free_slots()
+            if slots == 0:
+                return claimed
+
+            host_cpus, host_mem_mb = self.db.get_host_capacity()
+            used_cpus, used_mem_mb = self.db.get_reserved_resources()
+            queue_limits = self.db.get_queue_limits()
+            queue_running = self.db.count_running_by_queue()
+            full_queues = [name for name, limit in queue_limits.items()
+                           if queue_running.get(name, 0) >= limit]
+
+            for task in self.ready_tasks(slots, full_queues):
+                if len(claimed) >= slots:
+                    break
+
+                queue_limit = queue_limits.get(task.queue)
+                if queue_limit is not None and queue_running.get(task.queue, 0) >= queue_limit:
+                    continue
+
+                fits = (used_cpus + task.cpus <= host_cpus
+                        and used_mem_mb + task.mem_mb <= host_mem_mb)
+                # 超过主机总容量的任务在主机空闲时单独运行，避免永远无法启动
+                idle = used_cpus == 0 and used_mem_mb == 0
+                if not fits and not idle:
+                    continue
+
+                # 状态从pending到running的比较并设置，防止重复认领
+                if not self.db.claim_task(task.id):
+                    continue
+                used_cpus += task.cpus
+                used_mem_mb += task.mem_mb
+                queue_running[task.queue] = queue_running.get(task.queue, 0) + 1
+                claimed.append(task)
+        return claimed
+
+    def request_dispatch(self) -> Optional[List[int]]:
+        """有守护进程时唤醒它来调度并返回None，否则在当前进程内调度"""
+        if notify_daemon(self.db):
+            return None
+        return self.dispatch()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+Duration parsing for AtlasRun
+"""
+import math
+
+DURATION_UNITS = {
+    "s": 1,
+    "m": 60,
+    "h": 3600,
+    "d": 24 * 3600,
+    "w": 7 * 24 * 3600,
+}
+
+
+def parse_duration(value: str) -> float:
+    """解析时间长度（如 30s、15m、6h、2d），返回秒数；不带单位时按秒处理"""
+    text = value.strip().lower()
+    unit = text[-1:] if text[-1:] in DURATION_UNITS else "s"
+    number = text[:-1] if text[-1:] in DURATION_UNITS else text
+    try:
+        seconds = float(number) * DURATION_UNITS[unit]
+    except ValueError:
+        raise ValueError(f"Invalid duration: {value}")
+    # nan和inf作为超时或退避时间永远不会到期
+    if not math.isfinite(seconds) or seconds < 0:
+        raise ValueError(f"Invalid duration: {value}")
+    return seconds
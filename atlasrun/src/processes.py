@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Process identity helpers for AtlasRun
+
+PID会被系统复用，只检查PID是否存在无法判断记录的进程是否还是原来那个。
+这里同时比较开机ID（/proc/sys/kernel/random/boot_id）和进程启动时间
+（/proc/<pid>/stat 第22个字段，开机以来的时钟数）。
+"""
+import os
+import signal
+from typing import List, Optional, Tuple
+
+# 超时的任务收到SIGTERM后，超过这个时间（秒）仍未退出时发送SIGKILL
+KILL_GRACE_PERIOD = 10
+
+_boot_id = None
+
+
+def read_boot_id() -> Optional[str]:
+    """当前系统的开机ID，每次重启都会变化；无法读取时返回None"""
+    global _boot_id
+    if _boot_id is None:
+        try:
+            with open("/proc/sys/kernel/random/boot_id") as f:
+                _boot_id = f.read().strip()
+        except OSError:
+            return None
+    return _boot_id
+
+
+def read_process_stat(pid: int) -> Optional[Tuple[str, int, int]]:
+    """进程的状态、父进程PID和启动时间（开机以来的时钟数），进程不存在时返回None"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    # 进程名可能包含空格和括号，从最后一个右括号之后开始解析
+    fields = data[data.rindex(b")") + 2:].split()
+    return fields[0].decode(), int(fields[1]), int(fields[19])
+
+
+def read_process_start(pid: int) -> Optional[int]:
+    """进程的启动时间（开机以来的时钟数），进程不存在或已成为僵尸进程时返回None"""
+    stat = read_process_stat(pid)
+    if stat is None or stat[0] == "Z":
+        return None
+    return stat[2]
+
+
+def is_same_process(pid: int, start: Optional[int], boot_id: Optional[str]) -> bool:
+    """判断PID对应的进程是否仍是记录时的那个进程
+
+    已退出但还未被父进程回收的僵尸进程仍视为存活：调度守护进程回收子进程时才记录退出码，
+    在此之前不能把任务当作已丢失。父进程已退出（被init接管）的僵尸进程视为已退出。
+    没有记录启动时间和开机ID的旧任务，以及没有/proc的系统，退回到只检查PID是否存在。
+    """
+    current_boot_id = read_boot_id()
+    if boot_id is not None and current_boot_id is not None and boot_id != current_boot_id:
+        return False
+    if current_boot_id is None:
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+    stat = read_process_stat(pid)
+    if stat is None:
+        return False
+    state, parent, current_start = stat
+    if state == "Z" and parent == 1:
+        return False
+    return start is None or current_start == start
+
+
+def terminate_orphaned_group(pid: int, boot_id: Optional[str]) -> bool:
+    """终止监管进程已退出、但仍有成员存活的任务进程组，返回是否发送了信号
+
+    任务在以监管进程PID为ID的进程组中运行。只要组内还有进程，该PID就不会被
+    分配给新进程；因此只在PID当前不存在时发送信号，PID已被复用时不做任何事。
+    """
+    current_boot_id = read_boot_id()
+    if current_boot_id is None or (boot_id is not None and boot_id != current_boot_id):
+        return False
+    if read_process_start(pid) is not None:
+        return False
+    try:
+        os.killpg(pid, signal.SIGTERM)
+        return True
+    except OSError:
+        return False
+
+
+def signal_task(pid: int, signum: int) -> None:
+    """向任务的所有进程发送信号（当前进程除外）
+
+    任务在以pid为ID的会话和进程组中运行。runner本身也在这个进程组中，
+    无法用killpg发送SIGKILL，因此逐个向会话中的其他进程发送信号。
+    """
+    if os.getpgrp() != pid:
+        try:
+            os.killpg(pid, signum)
+        except OSError:
+            pass
+        return
+    own_pid = os.getpid()
+    for member in session_members(pid):
+        if member == own_pid:
+            continue
+        try:
+            os.kill(member, signum)
+        except OSError:
+            pass
+
+
+def session_members(session: int) -> List[int]:
+    """会话ID为session的所有进程"""
+    members = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "rb") as f:
+                data = f.read()
+        except OSError:
+            continue
+        if int(data[data.rindex(b")") + 2:].split()[3]) == session:
+            members.append(int(name))
+    return members
+
+
+def is_runner_process(pid: int) -> bool:
+    """判断进程是否为监管任务的runner"""
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return b"atlasrun.runner" in f.read()
+    except OSError:
+        return False
+
+
+def get_task_processes(pid: int) -> List[int]:
+    """任务仍然存活的进程（以pid为会话ID），不包括监管任务的runner和已不占用资源的僵尸进程"""
+    members = [member for member in session_members(pid)
+               if read_process_start(member) is not None]
+    if pid in members and is_runner_process(pid):
+        members.remove(pid)
+    return members
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Host resource detection and size parsing for AtlasRun
+"""
+import os
+
+MEMORY_UNITS = {
+    "K": 1 / 1024,
+    "M": 1,
+    "G": 1024,
+    "T": 1024 * 1024,
+}
+
+
+def parse_memory(value: str) -> int:
+    """解析内存大小（如 512M、32G、1.5T），返回MB；不带单位时按MB处理"""
+    text = value.strip().upper()
+    if text.endswith("B"):
+        text = text[:-1]
+    unit = text[-1:] if text[-1:] in MEMORY_UNITS else "M"
+    number = text[:-1] if text[-1:] in MEMORY_UNITS else text
+    try:
+        mem_mb = float(number) * MEMORY_UNITS[unit]
+    except ValueError:
+        raise ValueError(f"Invalid memory size: {value}")
+    if mem_mb < 0:
+        raise ValueError(f"Invalid memory size: {value}")
+    return int(mem_mb)
+
+
+def format_memory(mem_mb: int) -> str:
+    """格式化内存大小"""
+    if mem_mb >= 1024 * 1024:
+        return f"{mem_mb / (1024 * 1024):.1f}T"
+    if mem_mb >= 1024:
+        return f"{mem_mb / 1024:.1f}G"
+    return f"{mem_mb}M"
+
+
+def detect_host_cpus() -> int:
+    """检测当前进程可用的CPU核数"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def detect_host_mem_mb() -> int:
+    """从/proc/meminfo检测主机内存总量（MB）"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 0
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Command result cache for AtlasRun
+
+使用 --cache 提交的任务在启动前计算缓存键：命令、工作目录、声明的输出，以及每个
+输入文件的大小和修改时间。之前有相同缓存键的任务成功完成、且其输出都还存在时，
+直接复用它的结果，不再运行。输入输出的相对路径相对于任务的工作目录。
+"""
+import hashlib
+import json
+import os
+from typing import List, Optional
+from ..db import Task
+
+
+def split_paths(text: Optional[str]) -> List[str]:
+    """数据库中以换行分隔的路径列表"""
+    return [path for path in text.split("\n") if path] if text else []
+
+
+def resolve_path(working_dir: str, path: str) -> str:
+    """将输入输出路径解析为绝对路径"""
+    return os.path.join(working_dir, os.path.expanduser(path))
+
+
+def compute_cache_key(task: Task) -> Optional[str]:
+    """计算任务的缓存键，有输入文件不存在时返回None"""
+    inputs = []
+    for path in split_paths(task.inputs):
+        try:
+            stat = os.stat(resolve_path(task.working_dir, path))
+        except OSError:
+            return None
+        inputs.append([path, stat.st_size, stat.st_mtime_ns])
+    payload = json.dumps([task.command, task.working_dir, inputs, split_paths(task.outputs)])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def outputs_exist(working_dir: str, outputs: Optional[str]) -> bool:
+    """缓存条目声明的输出是否都还存在"""
+    return all(os.path.exists(resolve_path(working_dir, path)) for path in split_paths(outputs))
@@ -6,6 +6,9 @@ import time
 from datetime import datetime
 from tabulate import tabulate
 from ..db import TaskStatus
+from .resources import format_memory
+from .task_cache import split_paths
+from ..scheduler import get_daemon_pid
 
 
 def format_duration(start_time, end_time=None):
@@ -35,12 +38,31 @@ def format_duration(start_time, end_time=None):
 
 
 def format_time(timestamp):
-    """格式化时间戳"""
+    """格式化时间戳（非当天的时间会带上日期）"""
     if not timestamp:
         return "-"
     # 转换为秒级时间戳
     timestamp_sec = timestamp / 1000 if timestamp > 1000000000000 else timestamp
-    return datetime.fromtimestamp(timestamp_sec).strftime("%H:%M:%S")
+    moment = datetime.fromtimestamp(timestamp_sec)
+    if moment.date() != datetime.now().date():
+        return moment.strftime("%Y-%m-%d %H:%M:%S")
+    return moment.strftime("%H:%M:%S")
+
+
+def format_rss(rss_kb):
+    """格式化以KB为单位的内存大小"""
+    if rss_kb >= 1024:
+        return format_memory(int(rss_kb) // 1024)
+    return f"{int(rss_kb)}K"
+
+
+def format_rate(bytes_per_sec):
+    """格式化读写速率"""
+    for unit in ("B", "K", "M"):
+        if bytes_per_sec < 1024:
+            return f"{bytes_per_sec:.1f}{unit}/s"
+        bytes_per_sec /= 1024
+    return f"{bytes_per_sec:.1f}G/s"
 
 
 def get_status_icon(status):
@@ -49,29 +71,31 @@ def get_status_icon(status):
         TaskStatus.RUNNING: "▶",
         TaskStatus.PENDING: "⏳", 
         TaskStatus.COMPLETED: "✓",
-        TaskStatus.FAILED: "✗"
+        TaskStatus.FAILED: "✗",
+        TaskStatus.CANCELLED: "⊘",
+        TaskStatus.CANCELLING: "⊘"
     }
     return status_icons.get(status, "?")
 
 
-def list_tasks(db):
-    """显示任务列表"""
-    # 获取所有任务
-    all_tasks = db.get_all_tasks(limit=50)  # 限制显示最近50个任务
-    
-    if not all_tasks:
-        print("No tasks found")
-        return
+def list_tasks(db, status=None, working_dir=None, since=None,
+               after_id=None, before_id=None, limit=50, queue=None):
+    """显示任务列表（默认显示最近50个任务）"""
+    # 多取一个任务，用于判断是否还有下一页
+    tasks = db.get_tasks_page(status, working_dir, since, after_id, before_id, limit + 1, queue)
+    has_more = len(tasks) > limit
+    if has_more:
+        tasks = tasks[:limit] if after_id is not None else tasks[1:]
     
     # 准备表格数据
     table_data = []
     headers = ["ID", "Status", "PID", "Submit Time", "Duration", "Command"]
     
-    for task in all_tasks:
+    for task in tasks:
         # 计算运行时间
-        if task.status == TaskStatus.RUNNING and task.start_time:
+        if task.status in [TaskStatus.RUNNING, TaskStatus.CANCELLING] and task.start_time:
             duration = format_duration(task.start_time)
-        elif task.status in [TaskStatus.COMPLETED, TaskStatus.FAILED] and task.start_time and task.completed_at:
+        elif task.status in [TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.CANCELLED] and task.start_time and task.completed_at:
             duration = format_duration(task.start_time, task.completed_at)
         else:
             duration = "-"
@@ -90,8 +114,9 @@ def list_tasks(db):
         ]
         table_data.append(row)
     
-    # 按ID排序
-    table_data.sort(key=lambda x: x[0])
+    if not table_data:
+        print("No tasks found")
+        return
     
     # 使用tabulate打印表格
     print("\n" + tabulate(
@@ -100,26 +125,58 @@ def list_tasks(db):
         tablefmt="fancy_grid",
         colalign=("right", "left", "right", "right", "right", "left")
     ) + "\n")
+    
+    if has_more:
+        if after_id is not None:
+            print(f"More tasks available: use --after-id {tasks[-1].id} for the next page")
+        else:
+            print(f"Older tasks available: use --before-id {tasks[0].id} for the next page")
 
 
-def show_status(db):
+def show_status(db, head=10):
     """显示队列状态"""
-    pending_tasks = db.get_pending_tasks()
-    running_tasks = db.get_running_tasks()
+    summary = db.get_status_summary(head)
+    pending_count = summary.counts[TaskStatus.PENDING]
+    running_count = summary.counts[TaskStatus.RUNNING]
     
     print("=== AtlasRun Queue Status ===")
-    print(f"Pending tasks: {len(pending_tasks)}")
-    print(f"Running tasks: {len(running_tasks)}")
+    print(f"Pending tasks: {pending_count}")
+    print(f"Running tasks: {running_count}/{db.get_max_parallel()}")
+    print(f"Completed tasks: {summary.counts[TaskStatus.COMPLETED]}")
+    print(f"Failed tasks: {summary.counts[TaskStatus.FAILED]}")
+    if summary.counts[TaskStatus.CANCELLING]:
+        print(f"Cancelling tasks: {summary.counts[TaskStatus.CANCELLING]} (still holding their slots)")
+    if summary.counts[TaskStatus.CANCELLED]:
+        print(f"Cancelled tasks: {summary.counts[TaskStatus.CANCELLED]}")
+    host_cpus, host_mem_mb = db.get_host_capacity()
+    used_cpus, used_mem_mb = db.get_reserved_resources()
+    print(f"Reserved CPUs: {used_cpus}/{host_cpus}")
+    print(f"Reserved memory: {format_memory(used_mem_mb)}/{format_memory(host_mem_mb)}")
+    # 只有默认队列且未设置上限时不显示队列信息
+    if set(summary.queues) - {"default"} or any(limit for *_, limit in summary.queues.values()):
+        print("Queues:")
+        for name, (running, pending, limit) in sorted(summary.queues.items()):
+            print(f"  {name}: {running}/{limit if limit is not None else '-'} running, {pending} pending")
+    cache = db.get_cache_stats()
+    if cache.hits or cache.misses or cache.entries:
+        print(f"Result cache: {cache.hits} hit(s), {cache.misses} miss(es), "
+              f"{cache.entries}/{db.get_cache_max_entries()} entries")
+    daemon_pid = get_daemon_pid(db)
+    print(f"Scheduler daemon: {f'running (PID {daemon_pid})' if daemon_pid else 'not running'}")
     
-    if running_tasks:
+    if summary.running:
         print("\nRunning tasks:")
-        for task in running_tasks:
+        for task in summary.running:
             print(f"  {task.id}: {task.command} (PID: {task.pid})")
+        if running_count > len(summary.running):
+            print(f"  ... and {running_count - len(summary.running)} more")
     
-    if pending_tasks:
+    if summary.pending:
         print("\nPending tasks:")
-        for task in pending_tasks:
+        for task in summary.pending:
             print(f"  {task.id}: {task.command}")
+        if pending_count > len(summary.pending):
+            print(f"  ... and {pending_count - len(summary.pending)} more")
 
 
 def show_task_info(db, task_id):
@@ -135,11 +192,61 @@ def show_task_info(db, task_id):
     print(f"Working Directory: {task.working_dir}")
     print(f"Status: {task.status.value}")
     print(f"PID: {task.pid or 'N/A'}")
+    print(f"Reserved: {task.cpus} CPU(s), {format_memory(task.mem_mb) if task.mem_mb else 'no memory limit'}")
+    print(f"Queue: {task.queue} (priority {task.priority})")
+    if task.max_retries:
+        print(f"Attempts: {task.attempts} of {task.max_retries + 1} (backoff {task.backoff:g}s)")
+    if task.timeout:
+        print(f"Timeout: {task.timeout:g}s")
+    if task.cache:
+        print(f"Cache: inputs {', '.join(split_paths(task.inputs)) or '-'}; "
+              f"outputs {', '.join(split_paths(task.outputs)) or '-'}")
+        if task.cached_from is not None:
+            print(f"Cached: reused the result of task {task.cached_from}, not run")
+    if task.tag:
+        print(f"Tag: {task.tag}")
+    dependencies = db.get_task_dependencies(task_id)
+    if dependencies:
+        print("Depends on: " + ", ".join(
+            f"{dependency} ({status.value if status else 'cleaned up'})"
+            for dependency, status in dependencies))
     print(f"Created: {format_time(task.created_at)}")
     
+    if task.status == TaskStatus.PENDING and task.attempts:
+        last_exit = task.exit_code if task.exit_code is not None else 'unknown'
+        print(f"Retry at: {format_time(task.next_eligible_at)} (last attempt exit code {last_exit})")
+    
     if task.started_at:
         print(f"Started: {format_time(task.started_at)}")
     
     if task.completed_at:
         print(f"Completed: {format_time(task.completed_at)}")
-        print(f"Exit Code: {task.exit_code}")
+        print(f"Exit Code: {task.exit_code if task.exit_code is not None else 'unknown'}")
+    
+    if task.user_time is not None:
+        print(f"CPU Time: {task.user_time:.2f}s user, {task.system_time:.2f}s system")
+        print(f"Max RSS: {format_rss(task.max_rss_kb)}")
+
+
+def show_task_usage(db, task_id):
+    """显示任务资源使用采样的峰值和平均值"""
+    task = db.get_task_by_id(task_id)
+    if not task:
+        print(f"Task {task_id} not found")
+        return
+    
+    usage = db.get_usage_summary(task_id)
+    if not usage:
+        print(f"No usage samples for task {task_id} "
+              f"(enable sampling with 'arun --sample-interval' or run 'arun --sampler')")
+        return
+    
+    print(f"=== Task {task_id} Resource Usage ===")
+    print(f"Samples: {usage.samples} ({format_time(usage.first_at)} - {format_time(usage.last_at)})")
+    table_data = [
+        ["CPU", f"{usage.peak_cpu_percent:.1f}%", f"{usage.mean_cpu_percent:.1f}%"],
+        ["RSS", format_rss(usage.peak_rss_kb), format_rss(usage.mean_rss_kb)],
+        ["Read", format_rate(usage.peak_read_bps), format_rate(usage.mean_read_bps)],
+        ["Write", format_rate(usage.peak_write_bps), format_rate(usage.mean_write_bps)],
+    ]
+    print(tabulate(table_data, headers=["", "Peak", "Mean"], colalign=("left", "right", "right")))
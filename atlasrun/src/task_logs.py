@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Task log utilities for AtlasRun
+
+任务日志为 ~/.atlasrun/logs/task_<id>.out 和 .err。轮转后的旧日志命名为
+task_<id>.out.1、task_<id>.out.2……（数字越大越旧），可以是gzip（.gz）或
+zstd（.zst，需要安装zstandard）压缩的。读取时按块处理，内存占用与日志大小无关。
+
+任务运行时日志超过设定大小后以copytruncate方式轮转（任务以追加模式写日志，
+截断后从文件开头继续写入），截断后再压缩轮转出的分段，任务结束后压缩当前日志；日志目录超过配额时优先删除
+最早结束的任务的日志。
+"""
+import contextlib
+import errno
+import gzip
+import os
+import re
+import shutil
+import sys
+import time
+from collections import deque
+from pathlib import Path
+from typing import List
+from ..db import TaskStatus
+
+# 从文件末尾向前读取的块大小
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# 跟踪日志时的轮询间隔（秒）
+FOLLOW_POLL_INTERVAL = 0.5
+
+COMPRESSED_SUFFIXES = (".gz", ".zst")
+
+# 轮转和压缩时的块大小
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# gzip压缩级别，日志量大时速度优先
+GZIP_LEVEL = 1
+
+# 磁盘空间不足时的错误码
+DISK_FULL_ERRNOS = (errno.ENOSPC, errno.EDQUOT)
+
+_LOG_NAME = re.compile(r"task_(\d+)\.(?:out|err)(?:\.(\d+))?(?:\.gz|\.zst)?$")
+
+
+def get_log_dir() -> Path:
+    """任务日志目录"""
+    log_dir = Path.home() / ".atlasrun" / "logs"
+    log_dir.mkdir(parents=True, exist_ok=True)
+    return log_dir
+
+
+def get_log_path(task_id: int, stream: str = "out") -> Path:
+    """任务当前写入的日志路径，stream为out或err"""
+    return get_log_dir() / f"task_{task_id}.{stream}"
+
+
+def get_log_segments(task_id: int, stream: str = "out") -> List[Path]:
+    """任务日志的所有分段（包括轮转和压缩后的文件），按从旧到新排序"""
+    base = get_log_path(task_id, stream)
+    pattern = re.compile(re.escape(base.name) + r"(?:\.(\d+))?(?:\.gz|\.zst)?$")
+    segments = []
+    for path in base.parent.glob(base.name + "*"):
+        match = pattern.match(path.name)
+        if match:
+            number = int(match.group(1)) if match.group(1) else 0
+            segments.append((number, path))
+    # 数字越大越旧，没有数字的是当前（或任务结束后压缩的）日志
+    segments.sort(key=lambda segment: segment[0], reverse=True)
+    return [path for _, path in segments]
+
+
+def open_log(path: Path):
+    """以二进制方式打开日志，压缩日志在读取时流式解压"""
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    if path.suffix == ".zst":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(f"Reading {path.name} requires the zstandard package "
+                               f"(pip install zstandard)")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+
+@contextlib.contextmanager
+def open_task_logs(task_id: int):
+    """以追加模式打开任务的标准输出和错误输出日志
+
+    磁盘已满而无法打开日志时改为写入/dev/null，任务照常运行，不影响整个队列。
+    """
+    with contextlib.ExitStack() as stack:
+        logs = []
+        for stream in ("out", "err"):
+            try:
+                logs.append(stack.enter_context(open(get_log_path(task_id, stream), "ab")))
+            except OSError as e:
+                if e.errno not in DISK_FULL_ERRNOS:
+                    raise
+                print(f"Warning: {e}, output of task {task_id} is discarded", file=sys.stderr)
+                logs.append(stack.enter_context(open(os.devnull, "ab")))
+        yield logs[0], logs[1]
+
+
+def compressed_writer(path: Path, compression: str):
+    """创建压缩文件写入对象，返回 (文件对象, 实际使用的后缀)
+
+    compression为none时不压缩；未安装zstandard时zstd退回为gzip。
+    """
+    if compression == "none":
+        return open(path, "wb"), ""
+    if compression == "zstd":
+        try:
+            import zstandard
+            return zstandard.ZstdCompressor().stream_writer(open(f"{path}.zst", "wb")), ".zst"
+        except ImportError:
+            pass
+    return gzip.open(f"{path}.gz", "wb", compresslevel=GZIP_LEVEL), ".gz"
+
+
+def compress_stream(source, path: Path, compression: str, length: int = None) -> Path:
+    """将source的内容压缩写入path加压缩后缀的文件，返回压缩文件路径
+
+    失败（例如磁盘空间不足）时删除不完整的压缩文件并抛出异常。
+    """
+    writer, suffix = compressed_writer(path, compression)
+    target = Path(f"{path}{suffix}")
+    try:
+        with writer:
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = COPY_BLOCK_SIZE if remaining is None else min(COPY_BLOCK_SIZE, remaining)
+                chunk = source.read(size)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            target.unlink()
+        raise
+    return target
+
+
+def copy_until_idle(source, target) -> int:
+    """将source从当前位置复制到target，直到读到末尾时文件不再变大，返回复制的总字节数"""
+    copied = 0
+    while True:
+        chunk = source.read(COPY_BLOCK_SIZE)
+        if chunk:
+            target.write(chunk)
+            copied += len(chunk)
+        elif os.fstat(source.fileno()).st_size <= copied:
+            return copied
+
+
+def rotate_log(task_id: int, stream: str, policy) -> bool:
+    """日志超过policy.rotate_mb时轮转：已有分段编号加一，当前内容复制为第1段后截断，再压缩第1段
+
+    先不压缩地复制，任务在复制期间写入的内容也一并复制，截断之后才压缩，
+    因此丢失的只有最后一次读到末尾与截断之间写入的内容。
+    policy.keep大于0时只保留最新的keep个分段。返回是否执行了轮转。
+    """
+    path = get_log_path(task_id, stream)
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        return False
+    if not policy.rotate_mb or size < policy.rotate_mb * 1024 * 1024:
+        return False
+
+    # get_log_segments按从旧到新排序，编号从大到小依次重命名不会覆盖
+    for segment in get_log_segments(task_id, stream):
+        number = _LOG_NAME.match(segment.name).group(2)
+        if number is None:
+            continue
+        number = int(number)
+        if policy.keep and number >= policy.keep:
+            segment.unlink()
+        else:
+            segment.rename(segment.with_name(segment.name.replace(
+                f".{stream}.{number}", f".{stream}.{number + 1}", 1)))
+
+    rotated_path = path.with_name(f"{path.name}.1")
+    try:
+        with open(path, "rb") as source, open(rotated_path, "wb") as target:
+            copy_until_idle(source, target)
+            os.truncate(path, 0)
+    except OSError as e:
+        with contextlib.suppress(OSError):
+            rotated_path.unlink()
+        if e.errno not in DISK_FULL_ERRNOS:
+            raise
+        # 空间不足时放弃本次轮转，日志保持原样
+        return False
+
+    if policy.compression != "none":
+        # 压缩到隐藏的临时文件，完成后再替换未压缩的分段，读取日志时不会看到不完整的压缩文件
+        partial_path = rotated_path.with_name(f".{rotated_path.name}")
+        try:
+            with open(rotated_path, "rb") as f:
+                compressed = compress_stream(f, partial_path, policy.compression)
+        except OSError as e:
+            if e.errno not in DISK_FULL_ERRNOS:
+                raise
+            # 空间不足时保留未压缩的分段
+            return True
+        compressed.rename(rotated_path.with_name(rotated_path.name + compressed.suffix))
+        rotated_path.unlink()
+    return True
+
+
+def rotate_task_logs(task_id: int, policy) -> bool:
+    """检查并轮转任务的两个日志，返回是否轮转了其中之一"""
+    rotated = False
+    for stream in ("out", "err"):
+        rotated = rotate_log(task_id, stream, policy) or rotated
+    return rotated
+
+
+def finalize_task_logs(task_id: int, policy) -> None:
+    """任务结束后压缩日志，空日志直接删除"""
+    for stream in ("out", "err"):
+        path = get_log_path(task_id, stream)
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            continue
+        if size == 0:
+            path.unlink()
+            continue
+        if policy.compression == "none":
+            continue
+        try:
+            with open(path, "rb") as f:
+                compress_stream(f, path, policy.compression)
+        except OSError as e:
+            if e.errno not in DISK_FULL_ERRNOS:
+                raise
+            continue
+        path.unlink()
+
+
+def remove_task_logs(task_ids) -> int:
+    """删除指定任务的所有日志，返回删除的文件数"""
+    task_ids = set(task_ids)
+    removed = 0
+    for entry in os.scandir(get_log_dir()):
+        match = _LOG_NAME.match(entry.name)
+        if match and int(match.group(1)) in task_ids:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(entry.path)
+                removed += 1
+    return removed
+
+
+def enforce_log_quota(policy, active_task_ids) -> int:
+    """日志目录超过policy.quota_mb时删除日志，返回释放的字节数
+
+    active_task_ids为日志仍可能被写入的任务（包括由其他进程监管的任务和等待重试的任务）。
+    先按任务ID从小到大删除已结束任务的日志，仍然超出时再删除
+    这些任务最旧的轮转分段，正在写入的日志不会被删除。
+    """
+    if not policy.quota_mb:
+        return 0
+    active_task_ids = set(active_task_ids)
+    finished, rotated = [], []
+    total = 0
+    for entry in os.scandir(get_log_dir()):
+        match = _LOG_NAME.match(entry.name)
+        if not match:
+            continue
+        size = entry.stat().st_size
+        total += size
+        task_id, number = int(match.group(1)), int(match.group(2) or 0)
+        if task_id not in active_task_ids:
+            finished.append((task_id, -number, entry.path, size))
+        elif number:
+            rotated.append((-number, task_id, entry.path, size))
+
+    quota = policy.quota_mb * 1024 * 1024
+    freed = 0
+    for *_, path, size in sorted(finished) + sorted(rotated):
+        if total - freed <= quota:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+            freed += size
+    return freed
+
+
+def tail_file(path: Path, lines: int) -> List[bytes]:
+    """返回日志的最后若干行
+
+    未压缩的日志从文件末尾按块向前读取；压缩日志无法从末尾定位，
+    流式解压并只保留最后若干行。
+    """
+    if lines <= 0:
+        return []
+    if path.suffix in COMPRESSED_SUFFIXES:
+        with open_log(path) as f:
+            return list(deque(f, maxlen=lines))
+
+    with open(path, "rb") as f:
+        position = f.seek(0, os.SEEK_END)
+        blocks = []
+        newlines = 0
+        # 多读一个换行符，保证最前面的一行是完整的
+        while position > 0 and newlines <= lines:
+            size = min(TAIL_BLOCK_SIZE, position)
+            position -= size
+            f.seek(position)
+            block = f.read(size)
+            blocks.append(block)
+            newlines += block.count(b"\n")
+    data = b"".join(reversed(blocks))
+    return data.splitlines(keepends=True)[-lines:]
+
+
+def tail_log(task_id: int, stream: str, lines: int) -> List[bytes]:
+    """返回任务日志（跨轮转分段）的最后若干行"""
+    result = []
+    for path in reversed(get_log_segments(task_id, stream)):
+        result[:0] = tail_file(path, lines - len(result))
+        if len(result) >= lines:
+            break
+    return result
+
+
+def write_output(data: bytes) -> None:
+    """原样输出日志内容（不做解码）"""
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
+
+
+def print_log(task_id: int, stream: str) -> None:
+    """按从旧到新的顺序输出任务的完整日志"""
+    for path in get_log_segments(task_id, stream):
+        with open_log(path) as f:
+            shutil.copyfileobj(f, sys.stdout.buffer)
+    sys.stdout.buffer.flush()
+
+
+def copy_new_output(f) -> bool:
+    """输出打开的日志中新写入的内容，返回是否有新内容"""
+    copied = False
+    while True:
+        chunk = f.read(TAIL_BLOCK_SIZE)
+        if not chunk:
+            break
+        sys.stdout.buffer.write(chunk)
+        copied = True
+    sys.stdout.buffer.flush()
+    return copied
+
+
+def copy_rotated_rest(task_id: int, stream: str, position: int) -> None:
+    """日志被轮转截断后，从最新的轮转分段中输出position之后、截断之前写入的内容"""
+    for path in reversed(get_log_segments(task_id, stream)):
+        if _LOG_NAME.match(path.name).group(2) != "1":
+            continue
+        try:
+            with open_log(path) as f:
+                # 压缩的分段不能定位，读取并丢弃已经输出过的部分
+                while position > 0:
+                    skipped = len(f.read(min(COPY_BLOCK_SIZE, position)))
+                    if not skipped:
+                        return
+                    position -= skipped
+                copy_new_output(f)
+            return
+        except FileNotFoundError:
+            # 正在压缩的分段刚被替换，读取替换后的文件
+            continue
+
+
+def follow_log(db, task_id: int, stream: str) -> None:
+    """持续输出任务日志的新内容，直到任务结束
+
+    跟踪打开的文件而不是路径：任务结束后日志被压缩并删除时，仍能从打开的文件读完最后的输出。
+    """
+    path = get_log_path(task_id, stream)
+    f = None
+    first_open = True
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(path, "rb")
+                except FileNotFoundError:
+                    pass
+                else:
+                    # 已经输出过的内容不再重复，之后重新创建的日志从头读取
+                    if first_open:
+                        f.seek(0, os.SEEK_END)
+                    first_open = False
+            if f is not None:
+                position = f.tell()
+                if os.fstat(f.fileno()).st_size < position:
+                    # copytruncate轮转后从头读取，截断前还没读到的内容在第1个轮转分段中
+                    copy_rotated_rest(task_id, stream, position)
+                    f.seek(0)
+                if copy_new_output(f):
+                    continue
+                # 日志被删除后重新创建（例如重新排队）时改为跟踪新文件
+                try:
+                    replaced = os.stat(path).st_ino != os.fstat(f.fileno()).st_ino
+                except FileNotFoundError:
+                    replaced = False
+                if replaced:
+                    f.close()
+                    f = None
+                    continue
+
+            # 没有新内容时才检查任务是否已经结束，结束后读完打开的日志再退出
+            task = db.get_task_by_id(task_id)
+            if task is None or task.status not in (TaskStatus.PENDING, TaskStatus.RUNNING,
+                                                   TaskStatus.CANCELLING):
+                if f is not None:
+                    copy_new_output(f)
+                break
+            time.sleep(FOLLOW_POLL_INTERVAL)
+    finally:
+        if f is not None:
+            f.close()
+
+
+def show_task_log(db, task_id: int, stream: str = "out", lines: int = None,
+                  follow: bool = False) -> None:
+    """显示任务日志：lines为None时输出完整日志，follow时持续输出新内容"""
+    if db.get_task_by_id(task_id) is None:
+        print(f"Task {task_id} not found")
+        return
+    if follow and lines is None:
+        lines = 10
+
+    try:
+        if lines is None:
+            print_log(task_id, stream)
+        else:
+            write_output(b"".join(tail_log(task_id, stream, lines)))
+        if follow:
+            follow_log(db, task_id, stream)
+    except (OSError, RuntimeError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+测试任务表增长时常用查询的延迟
+
+用法: python benchmarks/bench_queries.py [--sizes 1000,10000,100000,1000000] [--repeat 200]
+
+每个规模都会新建一个临时数据库，写入大量已完成的历史任务，以及固定数量的
+pending和running任务，然后测量调度和状态查询的平均延迟。
+有索引时各查询的延迟不应随历史任务数增长而明显增加。
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from atlasrun.db import Database, TaskStatus
+from atlasrun.db.connection import get_connection
+
+PENDING_TASKS = 100
+RUNNING_TASKS = 8
+
+
+def populate(db: Database, rows: int) -> None:
+    """写入历史任务，最后的任务处于running和pending状态"""
+    conn = get_connection(db.db_path)
+    now = time.time() * 1000
+    history = rows - PENDING_TASKS - RUNNING_TASKS
+
+    def generate():
+        for i in range(rows):
+            created_at = now - (rows - i) * 1000
+            if i < history:
+                status = random.choice((TaskStatus.COMPLETED.value, TaskStatus.FAILED.value))
+                yield (f"echo {i}", "/tmp", status, 100000 + i, created_at,
+                       created_at, created_at, created_at + 500, 0)
+            elif i < history + RUNNING_TASKS:
+                yield (f"sleep {i}", "/tmp", TaskStatus.RUNNING.value, 100000 + i, created_at,
+                       created_at, created_at, None, None)
+            else:
+                yield (f"sleep {i}", "/tmp", TaskStatus.PENDING.value, None, created_at,
+                       None, None, None, None)
+
+    with conn:
+        conn.executemany("""
+            INSERT INTO tasks (command, working_dir, status, pid, created_at,
+                               started_at, start_time, completed_at, exit_code)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, generate())
+
+
+def measure(func, repeat: int) -> float:
+    """返回单次调用的平均耗时（毫秒）"""
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark AtlasRun task queries")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000",
+                        help="Comma separated table sizes")
+    parser.add_argument("--repeat", type=int, default=200,
+                        help="Number of calls per query")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    queries = [
+        ("next pending", lambda db: db.get_pending_tasks(limit=1)),
+        ("next ready", lambda db: db.get_ready_tasks(limit=1)),
+        ("running", lambda db: db.get_running_tasks()),
+        ("count running", lambda db: db.count_running_tasks()),
+        ("by pid", lambda db: db.get_task_by_pid(100000 + random.randrange(1000))),
+        ("latest 50", lambda db: db.get_all_tasks(limit=50)),
+        ("enqueue", lambda db: db.add_task("true", "/tmp")),
+    ]
+
+    print(f"{'rows':>10} " + " ".join(f"{name:>14}" for name, _ in queries) + "   (ms per call)")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            db = Database(os.path.join(tmp_dir, f"tasks_{size}.db"))
+            populate(db, size)
+            timings = [measure(lambda: query(db), args.repeat) for _, query in queries]
+            print(f"{size:>10} " + " ".join(f"{timing:>14.3f}" for timing in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+测试资源使用采样器的开销
+
+用法: python benchmarks/bench_sampler.py [--tasks 100] [--passes 50] [--interval 10]
+
+启动指定数量的sleep进程（每个在独立会话中，与实际任务相同），写入对应的
+running任务，然后重复采样，按每次采样消耗的CPU时间估算给定采样间隔下的CPU占用。
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from atlasrun.db import Database, TaskStatus
+from atlasrun.db.connection import get_connection
+from atlasrun.sampler import UsageSampler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the AtlasRun usage sampler")
+    parser.add_argument("--tasks", type=int, default=100, help="Number of running tasks")
+    parser.add_argument("--passes", type=int, default=50, help="Number of sampling passes")
+    parser.add_argument("--interval", type=float, default=10, help="Sampling interval (seconds)")
+    args = parser.parse_args()
+
+    processes = [subprocess.Popen(["bash", "-c", "sleep 600 & wait"], start_new_session=True)
+                 for _ in range(args.tasks)]
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = Database(os.path.join(tmp_dir, "tasks.db"))
+            now = time.time() * 1000
+            with get_connection(db.db_path) as conn:
+                conn.executemany("""
+                    INSERT INTO tasks (command, working_dir, status, pid, created_at,
+                                       started_at, start_time)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, [("sleep 600", "/tmp", TaskStatus.RUNNING.value, process.pid, now, now, now)
+                      for process in processes])
+
+            sampler = UsageSampler(db)
+            sampler.collect()
+            cpu_start = time.process_time()
+            wall_start = time.perf_counter()
+            for _ in range(args.passes):
+                sampled = sampler.collect()
+            cpu_per_pass = (time.process_time() - cpu_start) / args.passes
+            wall_per_pass = (time.perf_counter() - wall_start) / args.passes
+
+            print(f"tasks sampled per pass: {sampled}")
+            print(f"per pass: {cpu_per_pass * 1000:.2f} ms CPU, {wall_per_pass * 1000:.2f} ms wall")
+            print(f"CPU usage at {args.interval:g}s interval: {cpu_per_pass / args.interval * 100:.3f}%")
+    finally:
+        for process in processes:
+            os.killpg(process.pid, 15)
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
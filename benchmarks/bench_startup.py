@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+测试arun命令行的启动开销
+
+用法: python benchmarks/bench_startup.py [--runs 20]
+
+这里分别测量：
+  1. `python -X importtime` 下 atlasrun.cli 的模块导入耗时
+  2. 按PID更新状态的回调（--mark-complete）和普通命令（-s）的单次调用耗时
+所有调用都使用临时的HOME目录，不会影响 ~/.atlasrun。
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PACKAGE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def import_time_us(env) -> int:
+    """返回 atlasrun.cli 的累计导入耗时（微秒）"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import atlasrun.cli"],
+        env=env, capture_output=True, text=True, check=True
+    )
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == "atlasrun.cli":
+            return int(parts[1])
+    return 0
+
+
+def invocation_ms(args, env, runs: int):
+    """返回多次调用的耗时（毫秒）"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark arun startup latency")
+    parser.add_argument("--runs", type=int, default=20, help="Invocations per command")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home,
+                   PYTHONPATH=os.pathsep.join(filter(None, [PACKAGE_ROOT, os.environ.get("PYTHONPATH")])))
+        # 先初始化数据库，避免首次建表计入结果
+        subprocess.run([sys.executable, "-m", "atlasrun.cli", "-s"], env=env,
+                       stdout=subprocess.DEVNULL, check=True)
+
+        print(f"import atlasrun.cli: {import_time_us(env) / 1000:.1f} ms (cumulative, -X importtime)")
+        commands = [
+            ("python -c pass", ["-c", "pass"]),
+            ("arun --mark-complete", ["-m", "atlasrun.cli", "--mark-complete", "999999999"]),
+            ("arun -s", ["-m", "atlasrun.cli", "-s"]),
+        ]
+        for name, command in commands:
+            timings = invocation_ms(command, env, args.runs)
+            print(f"{name:<22} median {statistics.median(timings):7.1f} ms   "
+                  f"min {min(timings):7.1f} ms   ({args.runs} runs)")
+
+
+if __name__ == "__main__":
+    main()
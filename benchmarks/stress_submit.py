@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+并发提交压力测试
+
+用法: python benchmarks/stress_submit.py [--tasks 500] [--parallel 50] [--jobs 1]
+
+在临时HOME中同时启动大量 `arun` 提交进程，等待所有任务结束后检查：
+  1. 每次提交都得到一个唯一的任务，且所有任务都成功完成
+  2. 任意时刻运行中的任务数不超过 --jobs（按数据库中的开始和结束时间计算）
+  3. 任务按入队顺序（任务ID）启动，先入队的任务不会被后入队的任务抢先
+  4. --jobs 为1时，任务写入的标记行严格交替，没有两个任务同时运行
+检查失败时以非零状态退出。
+"""
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PACKAGE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def submit(env, command):
+    """提交一个命令，返回arun的输出"""
+    result = subprocess.run([sys.executable, "-m", "atlasrun.cli", command], env=env,
+                            capture_output=True, text=True, check=True)
+    return result.stdout
+
+
+def max_overlap(intervals):
+    """计算同时处于运行中的最大任务数"""
+    events = []
+    for start, end in intervals:
+        events.append((start, 1))
+        events.append((end, -1))
+    # 同一时刻先处理结束再处理开始
+    events.sort(key=lambda event: (event[0], event[1]))
+    running = peak = 0
+    for _, delta in events:
+        running += delta
+        peak = max(peak, running)
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress test concurrent arun submissions")
+    parser.add_argument("--tasks", type=int, default=500, help="Number of submissions")
+    parser.add_argument("--parallel", type=int, default=50,
+                        help="Number of arun processes submitting at the same time")
+    parser.add_argument("--jobs", type=int, default=1, help="Max parallel tasks of the queue")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="Seconds to wait for all tasks to finish")
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home,
+                   PYTHONPATH=os.pathsep.join(filter(None, [PACKAGE_ROOT, os.environ.get("PYTHONPATH")])))
+        subprocess.run([sys.executable, "-m", "atlasrun.cli", "-j", str(args.jobs),
+                        "--host-cpus", str(args.jobs)], env=env, stdout=subprocess.DEVNULL, check=True)
+        marker = os.path.join(home, "markers.txt")
+        command = f"echo start >> {marker}; sleep 0.01; echo end >> {marker}"
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.parallel) as pool:
+            list(pool.map(lambda _: submit(env, command), range(args.tasks)))
+        submit_time = time.perf_counter() - start
+        print(f"Submitted {args.tasks} task(s) from {args.parallel} concurrent submitters "
+              f"in {submit_time:.1f}s")
+
+        db_path = os.path.join(home, ".atlasrun", "tasks.db")
+        conn = sqlite3.connect(db_path, timeout=30)
+        deadline = time.time() + args.timeout
+        while True:
+            unfinished = conn.execute(
+                "SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'running')").fetchone()[0]
+            if unfinished == 0 or time.time() > deadline:
+                break
+            time.sleep(0.5)
+        print(f"All tasks finished after {time.perf_counter() - start:.1f}s"
+              if unfinished == 0 else f"Timed out with {unfinished} unfinished task(s)")
+
+        rows = conn.execute("""
+            SELECT id, status, start_time, completed_at FROM tasks ORDER BY id
+        """).fetchall()
+        if len(rows) != args.tasks:
+            failures.append(f"expected {args.tasks} tasks, found {len(rows)}")
+        not_completed = [row[0] for row in rows if row[1] != "completed"]
+        if not_completed:
+            failures.append(f"{len(not_completed)} task(s) did not complete: {not_completed[:10]}")
+
+        finished = [row for row in rows if row[2] and row[3]]
+        peak = max_overlap([(row[2], row[3]) for row in finished])
+        print(f"Max concurrently running tasks: {peak} (limit {args.jobs})")
+        if peak > args.jobs:
+            failures.append(f"{peak} tasks ran at the same time, limit is {args.jobs}")
+
+        start_order = [row[0] for row in sorted(finished, key=lambda row: row[2])]
+        if args.jobs == 1 and start_order != sorted(start_order):
+            failures.append("tasks did not start in submission order")
+
+        if args.jobs == 1 and os.path.exists(marker):
+            with open(marker) as f:
+                lines = f.read().split()
+            if lines != ["start", "end"] * (len(lines) // 2):
+                failures.append("task markers interleaved, tasks overlapped")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if not failures:
+        print("OK")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
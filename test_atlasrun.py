@@ -6,6 +6,17 @@ import os
 import time
 import subprocess
 from pathlib import Path
+import pytest
+from atlasrun.db import Database, LogPolicy, TaskStatus
+from atlasrun.db.connection import get_connection
+from atlasrun.cli import MAX_TASK_IDS, parse_task_ids, resolve_dependencies
+from atlasrun.daemon import SchedulerDaemon
+from atlasrun.scheduler import Scheduler
+from atlasrun.src.durations import parse_duration
+from atlasrun.src.processes import read_process_stat
+from atlasrun.src.task_logs import (
+    enforce_log_quota, get_log_path, get_log_segments, open_log, rotate_log
+)
 
 def test_basic_functionality():
     """测试基本功能"""
@@ -63,6 +74,386 @@ def test_queue_behavior():
                           capture_output=True, text=True)
     print(f"Final status: {result.stdout}")
 
+def make_database(tmp_path, monkeypatch):
+    """在临时HOME中创建数据库，任务日志也写入临时目录"""
+    monkeypatch.setenv("HOME", str(tmp_path))
+    (tmp_path / ".atlasrun").mkdir()
+    return Database(str(tmp_path / ".atlasrun" / "tasks.db"))
+
+
+def wait_until_exited(pid, timeout=10):
+    """等待子进程退出（成为尚未回收的僵尸进程）"""
+    deadline = time.monotonic() + timeout
+    while read_process_stat(pid)[0] != "Z":
+        assert time.monotonic() < deadline, f"process {pid} did not exit"
+        time.sleep(0.01)
+
+
+def run_daemon_round(daemon, db, task_id):
+    """等待守护进程启动的任务退出后回收，返回任务的最新状态"""
+    wait_until_exited(db.get_task_by_id(task_id).pid)
+    daemon.reap_children()
+    return db.get_task_by_id(task_id)
+
+
+def test_daemon_unreaped_child_not_lost(tmp_path, monkeypatch):
+    """守护进程尚未回收的已退出任务不会被当作丢失的任务"""
+    db = make_database(tmp_path, monkeypatch)
+    daemon = SchedulerDaemon(db)
+    try:
+        parent = db.add_task("true", str(tmp_path), max_retries=1)
+        child = db.add_task("true", str(tmp_path), depends_on=[parent])
+        assert daemon.scheduler.dispatch() == [parent]
+        wait_until_exited(db.get_task_by_id(parent).pid)
+
+        # 回收之前再次调度（以及其他进程的 arun -u）不会把任务标记为失败或重新排队
+        assert daemon.scheduler.recover_orphans() == []
+        assert daemon.scheduler.dispatch() == []
+        assert db.get_task_by_id(child).status == TaskStatus.PENDING
+
+        daemon.reap_children()
+        task = db.get_task_by_id(parent)
+        assert task.status == TaskStatus.COMPLETED
+        assert task.attempts == 1
+        assert daemon.scheduler.dispatch() == [child]
+        assert run_daemon_round(daemon, db, child).status == TaskStatus.COMPLETED
+    finally:
+        daemon.log_worker.shutdown(wait=True)
+
+
+def test_daemon_failed_task_retries_then_fails_dependents(tmp_path, monkeypatch):
+    """失败的任务按重试次数重新排队，重试用完后依赖它的任务随之失败"""
+    db = make_database(tmp_path, monkeypatch)
+    daemon = SchedulerDaemon(db)
+    try:
+        parent = db.add_task("exit 3", str(tmp_path), max_retries=1)
+        child = db.add_task("true", str(tmp_path), depends_on=[parent])
+        grandchild = db.add_task("true", str(tmp_path), depends_on=[child])
+
+        assert daemon.scheduler.dispatch() == [parent]
+        task = run_daemon_round(daemon, db, parent)
+        assert task.status == TaskStatus.PENDING
+        assert task.exit_code == 3
+        assert db.get_task_by_id(child).status == TaskStatus.PENDING
+
+        assert daemon.scheduler.dispatch() == [parent]
+        task = run_daemon_round(daemon, db, parent)
+        assert task.status == TaskStatus.FAILED
+        assert task.attempts == 2
+        assert db.get_task_by_id(child).status == TaskStatus.FAILED
+        assert db.get_task_by_id(grandchild).status == TaskStatus.FAILED
+        assert daemon.scheduler.dispatch() == []
+    finally:
+        daemon.log_worker.shutdown(wait=True)
+
+
+def test_stale_exit_does_not_overwrite_new_attempt(tmp_path, monkeypatch):
+    """任务已开始新一次运行后，旧进程的退出不会修改任务状态"""
+    db = make_database(tmp_path, monkeypatch)
+    task_id = db.add_task("true", str(tmp_path), max_retries=1)
+    assert db.claim_task(task_id)
+    db.update_pid(task_id, 1000001)
+    assert db.mark_task_lost(task_id)
+    assert db.get_task_by_id(task_id).status == TaskStatus.PENDING
+
+    assert db.claim_task(task_id)
+    db.update_pid(task_id, 1000002)
+    assert db.finish_task(task_id, 1000001, 0) is None
+    task = db.get_task_by_id(task_id)
+    assert task.status == TaskStatus.RUNNING
+    assert task.pid == 1000002
+    assert db.count_running_tasks() == 1
+
+    assert db.finish_task(task_id, 1000002, 0) == TaskStatus.COMPLETED
+
+
+def test_lost_task_without_retries_fails(tmp_path, monkeypatch):
+    """没有设置重试的丢失任务直接失败，包括升级前遗留、运行次数为0的running任务"""
+    db = make_database(tmp_path, monkeypatch)
+    claimed = db.add_task("true", str(tmp_path))
+    assert db.claim_task(claimed)
+    assert db.mark_task_lost(claimed)
+    assert db.get_task_by_id(claimed).status == TaskStatus.FAILED
+
+    legacy = db.add_task("true", str(tmp_path))
+    with get_connection(db.db_path) as conn:
+        conn.execute("UPDATE tasks SET status = ?, pid = ? WHERE id = ?",
+                     (TaskStatus.RUNNING.value, 4000000, legacy))
+    assert db.get_task_by_id(legacy).attempts == 0
+    assert Scheduler(db, None).recover_orphans() == [legacy]
+    assert db.get_task_by_id(legacy).status == TaskStatus.FAILED
+
+
+def test_cancelling_task_holds_slot_until_processes_exit(tmp_path, monkeypatch):
+    """被终止的任务在进程全部退出前继续占用槽位和资源"""
+    db = make_database(tmp_path, monkeypatch)
+    task_id = db.add_task("sleep 60", str(tmp_path), cpus=2)
+    waiting = db.add_task("true", str(tmp_path))
+    assert db.claim_task(task_id)
+    # 这个PID不存在，也没有以它为会话ID的进程
+    db.update_pid(task_id, 4000000)
+    assert db.cancel_task(task_id)
+    assert db.get_task_by_id(task_id).status == TaskStatus.CANCELLING
+    assert db.count_running_tasks() == 1
+    assert db.get_reserved_resources() == (2, 0)
+    # 监管进程记录退出码时不重试，也不释放槽位
+    assert db.finish_task(task_id, 4000000, -15) == TaskStatus.CANCELLED
+    assert db.get_task_by_id(task_id).status == TaskStatus.CANCELLING
+
+    # 终止任务的 arun --kill 被中断时，调度器确认进程已全部退出后释放槽位
+    assert Scheduler(db, None).recover_orphans() == []
+    task = db.get_task_by_id(task_id)
+    assert task.status == TaskStatus.CANCELLED
+    assert task.exit_code == -15
+    assert db.count_running_tasks() == 0
+    assert db.get_task_by_id(waiting).status == TaskStatus.PENDING
+
+
+def test_parse_task_ids_limits_range():
+    """输错的大范围直接报错，不逐个生成ID"""
+    assert parse_task_ids("3,5-7") == [3, 5, 6, 7]
+    with pytest.raises(ValueError):
+        parse_task_ids(f"1-{MAX_TASK_IDS + 1}")
+
+
+def run_cached_task(db, task_id, pid=4000000):
+    """认领使用缓存的任务并检查缓存，未命中时模拟运行成功，返回是否命中"""
+    assert db.claim_task(task_id)
+    if Scheduler(db, None).reuse_cached_result(db.get_task_by_id(task_id)):
+        return True
+    db.update_pid(task_id, pid)
+    assert db.finish_task(task_id, pid, 0) == TaskStatus.COMPLETED
+    return False
+
+
+def test_requeue_reruns_cached_task(tmp_path, monkeypatch):
+    """重新排队的任务不会复用它自己写入的缓存结果"""
+    db = make_database(tmp_path, monkeypatch)
+    (tmp_path / "out.txt").write_text("result")
+    task_id = db.add_task("make out.txt", str(tmp_path), cache=True, outputs=["out.txt"])
+    assert not run_cached_task(db, task_id)
+    assert db.get_cache_stats().entries == 1
+
+    assert db.requeue_task(task_id)
+    assert db.get_cache_stats().entries == 0
+    assert not run_cached_task(db, task_id)
+    task = db.get_task_by_id(task_id)
+    assert task.status == TaskStatus.COMPLETED
+    assert task.cached_from is None
+
+
+def test_ready_tasks_follow_dependency_status(tmp_path, monkeypatch):
+    """依赖的任务成功完成后下游任务才可以启动，依赖重新排队后下游任务重新等待"""
+    db = make_database(tmp_path, monkeypatch)
+    first = db.add_task("true", str(tmp_path))
+    second = db.add_task("true", str(tmp_path))
+    child = db.add_task("true", str(tmp_path), depends_on=[first, second])
+    assert [task.id for task in db.get_ready_tasks()] == [first, second]
+
+    assert db.claim_task(first)
+    db.complete_task(first)
+    assert [task.id for task in db.get_ready_tasks()] == [second]
+    assert db.claim_task(second)
+    db.complete_task(second)
+    assert [task.id for task in db.get_ready_tasks()] == [child]
+
+    assert db.requeue_task(first)
+    assert [task.id for task in db.get_ready_tasks()] == [first]
+    with get_connection(db.db_path) as conn:
+        assert conn.execute("SELECT unmet_deps FROM tasks WHERE id = ?", (child,)).fetchone()[0] == 1
+
+
+def test_tag_dependencies_ignore_old_failures(tmp_path, monkeypatch):
+    """标签只解析为未结束的任务和每个命令最近一次成功的运行"""
+    db = make_database(tmp_path, monkeypatch)
+    old = db.add_tasks(["step 1", "step 2"], str(tmp_path), tag="map")
+    for pid, task_id in enumerate(old, start=4000000):
+        assert db.claim_task(task_id)
+        db.update_pid(task_id, pid)
+    assert db.finish_task(old[0], 4000000, 0) == TaskStatus.COMPLETED
+    assert db.finish_task(old[1], 4000001, 1) == TaskStatus.FAILED
+    rerun = db.add_task("step 2", str(tmp_path), tag="map")
+
+    assert resolve_dependencies(db, "map") == [old[0], rerun]
+    child = db.add_task("true", str(tmp_path), depends_on=resolve_dependencies(db, "map"))
+    assert db.get_task_by_id(child).status == TaskStatus.PENDING
+    with pytest.raises(ValueError):
+        resolve_dependencies(db, "reduce")
+
+
+def test_cache_hits_misses_and_evicts_least_recently_used(tmp_path, monkeypatch):
+    """相同的命令复用已有结果，超过条目上限时淘汰最久未使用的条目"""
+    db = make_database(tmp_path, monkeypatch)
+    db.set_cache_max_entries(1)
+    (tmp_path / "a.txt").write_text("a")
+    (tmp_path / "b.txt").write_text("b")
+    first = db.add_task("make a.txt", str(tmp_path), cache=True, outputs=["a.txt"])
+    assert not run_cached_task(db, first)
+
+    again = db.add_task("make a.txt", str(tmp_path), cache=True, outputs=["a.txt"])
+    assert run_cached_task(db, again)
+    assert db.get_task_by_id(again).cached_from == first
+
+    other = db.add_task("make b.txt", str(tmp_path), cache=True, outputs=["b.txt"])
+    assert not run_cached_task(db, other)
+    assert db.get_cache_stats().entries == 1
+    evicted = db.add_task("make a.txt", str(tmp_path), cache=True, outputs=["a.txt"])
+    assert not run_cached_task(db, evicted)
+
+    # 输出被删除的条目不再复用
+    (tmp_path / "a.txt").unlink()
+    missing = db.add_task("make a.txt", str(tmp_path), cache=True, outputs=["a.txt"])
+    assert not run_cached_task(db, missing)
+    assert db.get_cache_stats() == (1, 4, 1)
+
+
+def test_tasks_page_uses_id_keyset(tmp_path, monkeypatch):
+    """分页按ID前后翻页，结果始终按ID升序"""
+    db = make_database(tmp_path, monkeypatch)
+    first, last = db.add_tasks([f"echo {i}" for i in range(5)], str(tmp_path))
+    ids = list(range(first, last + 1))
+    assert db.claim_task(ids[1])
+
+    assert [task.id for task in db.get_tasks_page(limit=2)] == ids[3:]
+    assert [task.id for task in db.get_tasks_page(before_id=ids[3], limit=2)] == ids[1:3]
+    assert [task.id for task in db.get_tasks_page(after_id=ids[0], limit=2)] == ids[1:3]
+    assert [task.id for task in db.get_tasks_page(after_id=ids[4])] == []
+    assert [task.id for task in db.get_tasks_page(status=TaskStatus.PENDING, limit=2)] == ids[3:]
+    assert [task.id for task in db.get_tasks_page(status=TaskStatus.RUNNING)] == [ids[1]]
+
+
+def test_claim_tasks_orders_by_priority_within_queue_limits(tmp_path, monkeypatch):
+    """按优先级和入队顺序认领任务，已满的队列不挡住其他队列"""
+    db = make_database(tmp_path, monkeypatch)
+    db.set_max_parallel(3)
+    db.set_host_capacity(cpus=8, mem_mb=1024)
+    db.set_queue_limit("gpu", 1)
+    gpu_first = db.add_task("true", str(tmp_path), queue="gpu")
+    gpu_second = db.add_task("true", str(tmp_path), queue="gpu")
+    low = db.add_task("true", str(tmp_path))
+    high = db.add_task("true", str(tmp_path), priority=5)
+
+    scheduler = Scheduler(db, None)
+    assert [task.id for task in scheduler.claim_tasks()] == [high, gpu_first, low]
+    assert scheduler.claim_tasks() == []
+    db.complete_task(gpu_first)
+    assert [task.id for task in scheduler.claim_tasks()] == [gpu_second]
+
+
+def test_claim_tasks_backfills_free_resources(tmp_path, monkeypatch):
+    """放不下的大任务不挡住后面的小任务，超过主机容量的任务在主机空闲时单独运行"""
+    db = make_database(tmp_path, monkeypatch)
+    db.set_max_parallel(10)
+    db.set_host_capacity(cpus=4, mem_mb=1024)
+    running = db.add_task("true", str(tmp_path), cpus=2)
+    big = db.add_task("true", str(tmp_path), cpus=3)
+    first, last = db.add_tasks(["true", "true", "true"], str(tmp_path), cpus=1)
+    small = list(range(first, last + 1))
+    huge = db.add_task("true", str(tmp_path), cpus=16)
+
+    scheduler = Scheduler(db, None)
+    assert [task.id for task in scheduler.claim_tasks()] == [running, small[0], small[1]]
+    for task_id in [running, small[0], small[1]]:
+        db.complete_task(task_id)
+    assert [task.id for task in scheduler.claim_tasks()] == [big, small[2]]
+    db.complete_task(big)
+    db.complete_task(small[2])
+    assert [task.id for task in scheduler.claim_tasks()] == [huge]
+    assert db.get_reserved_resources() == (16, 0)
+
+
+def test_add_tasks_assigns_contiguous_ids(tmp_path, monkeypatch):
+    """批量提交的任务ID连续，顺序与命令一致"""
+    db = make_database(tmp_path, monkeypatch)
+    db.add_task("true", str(tmp_path))
+    commands = [f"echo {i}" for i in range(100)]
+    first, last = db.add_tasks(commands, str(tmp_path), tag="batch")
+    assert last - first + 1 == len(commands)
+    assert [task.command for task in db.get_tasks_page(after_id=first - 1, limit=200)] == commands
+
+
+def test_dependency_failure_propagates_and_requeue_resets(tmp_path, monkeypatch):
+    """依赖失败的任务随之失败，重新排队后依赖不再失败的下游任务一并恢复"""
+    db = make_database(tmp_path, monkeypatch)
+    parent = db.add_task("exit 1", str(tmp_path))
+    other = db.add_task("exit 1", str(tmp_path))
+    child = db.add_task("true", str(tmp_path), depends_on=[parent])
+    grandchild = db.add_task("true", str(tmp_path), depends_on=[child])
+    joined = db.add_task("true", str(tmp_path), depends_on=[parent, other])
+    for pid, task_id in enumerate([parent, other], start=4000000):
+        assert db.claim_task(task_id)
+        db.update_pid(task_id, pid)
+        assert db.finish_task(task_id, pid, 1) == TaskStatus.FAILED
+    for task_id in [child, grandchild, joined]:
+        assert db.get_task_by_id(task_id).status == TaskStatus.FAILED
+    # 提交时依赖已经失败的任务直接失败
+    late = db.add_task("true", str(tmp_path), depends_on=[parent])
+    assert db.get_task_by_id(late).status == TaskStatus.FAILED
+
+    assert db.requeue_task(parent)
+    for task_id in [parent, child, grandchild, late]:
+        assert db.get_task_by_id(task_id).status == TaskStatus.PENDING
+    assert db.get_task_by_id(joined).status == TaskStatus.FAILED
+    assert [task.id for task in db.get_ready_tasks()] == [parent]
+
+    assert db.cancel_task(parent)
+    for task_id in [child, grandchild, late]:
+        assert db.get_task_by_id(task_id).status == TaskStatus.CANCELLED
+
+
+def test_parse_duration_rejects_non_finite():
+    """时间长度支持单位，nan、inf和负数报错"""
+    assert parse_duration("90") == 90
+    assert parse_duration("1.5h") == 5400
+    for value in ("nan", "inf", "-inf", "infs", "-1m", "abc"):
+        with pytest.raises(ValueError):
+            parse_duration(value)
+
+
+def test_rotate_log_keeps_all_output(tmp_path, monkeypatch):
+    """轮转后各分段按顺序拼接与原日志一致，轮转出的分段被压缩"""
+    make_database(tmp_path, monkeypatch)
+    policy = LogPolicy(rotate_mb=1, keep=0, compression="gzip", quota_mb=0)
+    path = get_log_path(1)
+    expected = b""
+    for part in range(3):
+        data = b"".join(b"%d-%d\n" % (part, i) for i in range(200000))
+        with open(path, "ab") as f:
+            f.write(data)
+        expected += data
+        assert rotate_log(1, "out", policy)
+    assert path.stat().st_size == 0
+    segments = get_log_segments(1)
+    assert [segment.name for segment in segments] == [
+        "task_1.out.3.gz", "task_1.out.2.gz", "task_1.out.1.gz", "task_1.out"]
+    content = b""
+    for segment in segments:
+        with open_log(segment) as f:
+            content += f.read()
+    assert content == expected
+
+
+def test_log_quota_keeps_logs_of_unfinished_tasks(tmp_path, monkeypatch):
+    """超过配额时只删除已结束任务的日志，其他进程监管的任务和等待重试的任务的日志保留"""
+    db = make_database(tmp_path, monkeypatch)
+    finished = db.add_task("true", str(tmp_path))
+    running = db.add_task("true", str(tmp_path))
+    retrying = db.add_task("false", str(tmp_path), max_retries=1)
+    for task_id in (finished, running, retrying):
+        assert db.claim_task(task_id)
+        db.update_pid(task_id, 4000000 + task_id)
+        get_log_path(task_id).write_bytes(b"x" * 1024 * 1024)
+    assert db.finish_task(finished, 4000000 + finished, 0) == TaskStatus.COMPLETED
+    assert db.finish_task(retrying, 4000000 + retrying, 1) == TaskStatus.PENDING
+
+    policy = LogPolicy(rotate_mb=0, keep=0, compression="none", quota_mb=1)
+    assert sorted(db.get_log_writer_ids()) == [running, retrying]
+    enforce_log_quota(policy, db.get_log_writer_ids())
+    assert not get_log_path(finished).exists()
+    assert get_log_path(running).exists()
+    assert get_log_path(retrying).exists()
+
+
 if __name__ == '__main__':
     test_basic_functionality()
     test_queue_behavior()